@@ -0,0 +1,190 @@
+# Stand-ins for the discord objects the cog touches, enough to drive VIPCommand offline.
+# Members, roles and the guild are plain objects, role changes and messages only update them in memory. When the guild
+# has a FakeDiscordAPI, every call that would be an HTTP request goes through it first and pays its latency and limits.
+import asyncio
+import logging
+import math
+import random
+import time
+from types import SimpleNamespace
+import discord
+
+VIP_ROLE = '🌟 VIP'
+ADMIN_ROLE = '🛡️ Admin'
+OWNER_ROLE = '👑 Owner'
+
+# the logger py-cord reports rate limits on
+_log = logging.getLogger('discord.http')
+
+
+class FakeResponse:
+    # what discord.HTTPException reads from an aiohttp response
+    def __init__(self, status: int, reason: str, headers: dict = None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class FakeDiscordAPI:
+    # The HTTP surface the cog uses, with a latency per request and fixed window rate limits per bucket. Buckets map a
+    # route to (requests, per seconds), the window is kept per route and major parameter like Discord does (the guild for
+    # role changes, the channel for DMs). A request over the limit gets a 429 that is handled like py-cord's
+    # HTTPClient.request does: it logs the same warning, sleeps for retry_after and tries again. A DM to a member in
+    # closed_dms fails with a 403
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, buckets: dict = None, closed_dms: set = (), seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.buckets = buckets if buckets is not None else {'roles': (50, 1.0), 'dm': (5, 5.0), 'users': (50, 1.0)}
+        self.closed_dms = set(closed_dms)
+        self.requests = {}
+        self.rate_limited = {}
+        self.forbidden = 0
+        # seconds from the first attempt of a request to its success, sleeps after a 429 included
+        self.latencies = {}
+        # when each successful request finished (time.monotonic)
+        self.completed = {}
+        self._windows = {}
+        self._random = random.Random(seed)
+
+    async def request(self, route: str, major: int) -> None:
+        first_attempt = time.monotonic()
+        while (retry_after := self._take(route, major)) is not None:
+            self.rate_limited[route] = self.rate_limited.get(route, 0) + 1
+            _log.warning('We are being rate limited. Retrying in %.2f seconds. Handled under the bucket "%s"',
+                         retry_after, f'{major}:{major}:/{route}')
+            await asyncio.sleep(retry_after)
+        await asyncio.sleep(max(0.0, self._random.gauss(self.latency, self.jitter)))
+        self.latencies.setdefault(route, []).append(time.monotonic() - first_attempt)
+        self.completed.setdefault(route, []).append(time.monotonic())
+
+    def _take(self, route: str, major: int):
+        # counts one request against its window, returns how long to wait instead when the window is full
+        now = time.monotonic()
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if route not in self.buckets:
+            return None
+        limit, per = self.buckets[route]
+        window_start, count = self._windows.get((route, major), (now, 0))
+        if now - window_start >= per:
+            window_start, count = now, 0
+        if count >= limit:
+            # rounded up like Discord does, a retry after exactly that long lands in the next window
+            return math.ceil((window_start + per - now) * 1000) / 1000
+        self._windows[(route, major)] = (window_start, count + 1)
+        return None
+
+    async def send_dm(self, member_id: int) -> None:
+        await self.request('dm', member_id)
+        if member_id in self.closed_dms:
+            self.forbidden += 1
+            raise discord.Forbidden(FakeResponse(403, 'Forbidden'), {'code': 50007, 'message': 'Cannot send messages to this user'})
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+        self.members = []
+
+    def __repr__(self):
+        return self.name
+
+
+class FakeMember:
+    def __init__(self, guild, member_id: int, name: str, administrator: bool = False, bot: bool = False):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.discriminator = '0001'
+        self.bot = bot
+        self.mention = f'<@{member_id}>'
+        self.guild_permissions = SimpleNamespace(administrator=administrator)
+        self.roles = []
+        self.messages = []
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+    async def add_roles(self, *roles):
+        for role in roles:
+            if self.guild.api is not None:
+                await self.guild.api.request('roles', self.guild.id)
+            if role not in self.roles:
+                self.roles.append(role)
+                role.members.append(self)
+
+    async def remove_roles(self, *roles):
+        for role in roles:
+            if self.guild.api is not None:
+                await self.guild.api.request('roles', self.guild.id)
+            if role in self.roles:
+                self.roles.remove(role)
+                role.members.remove(self)
+
+    async def send(self, **kwargs):
+        if self.guild.api is not None:
+            await self.guild.api.send_dm(self.id)
+        self.messages.append(kwargs)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1, api: FakeDiscordAPI = None):
+        self.id = guild_id
+        self.api = api
+        self.filesize_limit = 25 * 1024 * 1024
+        self.roles = [FakeRole(1, VIP_ROLE), FakeRole(2, ADMIN_ROLE), FakeRole(3, OWNER_ROLE)]
+        self.members = []
+        self._members = {}
+
+    def add_member(self, member_id: int, name: str, roles: list[str] = (), administrator: bool = False, bot: bool = False) -> FakeMember:
+        member = FakeMember(self, member_id, name, administrator, bot)
+        for role in self.roles:
+            if role.name in roles:
+                member.roles.append(role)
+                role.members.append(member)
+        self.members.append(member)
+        self._members[member_id] = member
+        return member
+
+    def get_member(self, member_id: int):
+        return self._members.get(member_id)
+
+
+class FakeBot:
+    # never becomes ready, so the cog's background loops stay parked in their before_loop
+    def __init__(self, guild: FakeGuild, user: FakeMember, owner: FakeMember):
+        self.guilds = [guild]
+        self.user = user
+        self.owner = owner
+        self.latency = 0.05
+        self._ready = asyncio.Event()
+
+    def remove_command(self, name: str):
+        pass
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
+
+    async def fetch_user(self, user_id):
+        if self.guilds[0].api is not None:
+            await self.guilds[0].api.request('users', None)
+        return self.owner
+
+
+class FakeContext:
+    # what a slash command callback uses of its ApplicationContext, responses are kept for inspection
+    def __init__(self, bot: FakeBot, author: FakeMember, command: str):
+        self.bot = bot
+        self.guild = author.guild
+        self.author = author
+        self.command = SimpleNamespace(name=command)
+        self.responses = []
+
+    async def defer(self):
+        if self.guild.api is not None:
+            await self.guild.api.request('interactions', self.author.id)
+
+    async def respond(self, **kwargs):
+        if self.guild.api is not None:
+            await self.guild.api.request('interactions', self.author.id)
+        self.responses.append(kwargs)
@@ -0,0 +1,109 @@
+# Compares the old per-member /grantall loop with ops.grant_subscriptions on a seeded database.
+# usage: python benchmarks/grantall.py --members 10000 --active 0.3
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+BOT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot')
+
+
+async def seed(ops, mdls, members: int, active: float) -> tuple:
+    ops.init_db()
+    async with ops.unit_of_work() as session:
+        session.add(mdls.SubDuration(1, 'month'))
+    duration = await ops.get_sub_duration(1, 'month')
+
+    rng = random.Random(42)
+    guild = [(discord_uid, f'member{discord_uid}#0001') for discord_uid in range(1, members + 1)]
+    # only part of the guild is registered already, some of those have a running subscription
+    await ops.register_users([member for member in guild if rng.random() < 0.8])
+    async with ops.unit_of_work() as session:
+        for user in await ops.get_users(session):
+            if rng.random() < active:
+                await ops.create_subscription(user, duration, session)
+    admin = mdls.User(0, 'admin#0001')
+    await ops.add_user(admin)
+    return guild, duration, admin
+
+
+async def legacy_grant_all(ops, utls, guild, duration, admin) -> list:
+    import models as mdls
+    outcomes = []
+    for discord_uid, username in guild:
+        name, discriminator = username.split('#')
+        user, isNew = await utls.get_or_add_member(SimpleNamespace(id=discord_uid, name=name, discriminator=discriminator))
+        original_end_date = None
+        subscription = await ops.get_active_subscription(user)
+        extension = False
+        if subscription and subscription.is_now_active():
+            extension = True
+            subscription, original_end_date = await ops.extend_subscription(subscription, duration)
+        else:
+            subscription = await ops.create_subscription(user, duration)
+        if original_end_date is None:
+            original_end_date = subscription.end_date
+        action_type = 'extend' if extension else 'grant'
+        await ops.add_grant(mdls.Grant(datetime.now(), original_end_date, subscription.end_date, duration, subscription, admin, user, action_type=action_type))
+        outcomes.append((discord_uid, action_type, original_end_date, subscription.end_date))
+    return outcomes
+
+
+async def run_mode(mode: str, members: int, active: float) -> dict:
+    sys.path.insert(0, BOT_FOLDER)
+    from sqlalchemy import event
+    import operations as ops
+    import models as mdls
+    import utils as utls
+
+    guild, duration, admin = await seed(ops, mdls, members, active)
+    statements = [0]
+    event.listen(ops.async_engine.sync_engine, 'before_cursor_execute', lambda *args: statements.__setitem__(0, statements[0] + 1))
+
+    start_time = time.perf_counter()
+    if mode == 'legacy':
+        outcomes = await legacy_grant_all(ops, utls, guild, duration, admin)
+    else:
+        outcomes = await ops.grant_subscriptions(guild, duration, admin)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        'mode': mode,
+        'members': members,
+        'seconds': round(elapsed, 3),
+        'statements': statements[0],
+        'granted': sum(1 for outcome in outcomes if outcome[1] == 'grant'),
+        'extended': sum(1 for outcome in outcomes if outcome[1] == 'extend'),
+    }
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--members', type=int, default=2000, help='Number of guild members')
+    parser.add_argument('-a', '--active', type=float, default=0.3, help='Share of registered users with an active subscription')
+    parser.add_argument('--mode', choices=['legacy', 'bulk'], help='Run a single mode in this process (used internally)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode:
+        print(json.dumps(asyncio.run(run_mode(args.mode, args.members, args.active))))
+        sys.exit()
+
+    results = {}
+    for mode in ['legacy', 'bulk']:
+        # every mode gets its own database, the engine is bound to DATABASE_FILE at import time
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ, DATABASE_FILE=os.path.join(folder, 'database.db'))
+            output = subprocess.run([sys.executable, __file__, '--mode', mode, '--members', str(args.members), '--active', str(args.active)], env=env, capture_output=True, text=True, check=True)
+            results[mode] = json.loads(output.stdout.strip().splitlines()[-1])
+        print(json.dumps(results[mode]))
+    print(f"speedup: {results['legacy']['seconds'] / max(results['bulk']['seconds'], 1e-9):.1f}x")
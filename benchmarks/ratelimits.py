@@ -0,0 +1,118 @@
+# Runs a mass command against the FakeDiscordAPI stand-in, with its latency, per bucket 429s and closed DMs, and reports
+# the throughput and tail latency of the role changes and DMs it causes. The limits turn it into a regression test.
+# usage: python benchmarks/ratelimits.py --command grant_all --members 2000 --role-limit 50 --role-per 1 --max-p99 30
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from fakes import FakeDiscordAPI, FakeContext
+from suite import BOT_FOLDER, ADMIN_UID, FIRST_MEMBER_UID, seed, build_guild
+
+COMMANDS = ['grant_all', 'revoke_all', 'check_subscriptions']
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(share * len(values)))], 3)
+
+
+def summarize(values: list[float]) -> dict:
+    return {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99), 'max': percentile(values, 1.0)}
+
+
+async def run(args) -> dict:
+    sys.path.insert(0, BOT_FOLDER)
+    os.environ.setdefault('ADMIN_USER_ID', str(ADMIN_UID))
+    os.environ['ROLE_DISPATCH_WORKERS'] = str(args.workers)
+    import operations as ops
+    import metrics
+    from cogs.vipcog import VIPCommand
+
+    # the fake API logs its 429s like py-cord does, they end up in the metric instead of on stderr
+    metrics.watch_rate_limits()
+
+    ops.init_db()
+    rng = random.Random(42)
+    closed_dms = {FIRST_MEMBER_UID + number for number in range(args.members) if rng.random() < args.closed_dms}
+    buckets = {'roles': (args.role_limit, args.role_per), 'dm': (args.dm_limit, args.dm_per), 'users': (50, 1.0)}
+    api = FakeDiscordAPI(args.latency, args.jitter, buckets, closed_dms)
+    guild, bot, admin = build_guild(seed(ops.DATABASE_FILE, args.members), api)
+    cog = VIPCommand(bot)
+    # members are only messaged outside quiet mode, and role changes of /revokeall only happen in role change mode
+    cog.silent = False
+    cog.role_change_mode = True
+
+    start_time = time.monotonic()
+    if args.command == 'check_subscriptions':
+        await cog.check_subscriptions()
+    else:
+        ctx = FakeContext(bot, admin, args.command)
+        await (cog.grant_all.callback(cog, ctx, '1m') if args.command == 'grant_all' else cog.revoke_all.callback(cog, ctx, '', ''))
+    command_seconds = time.monotonic() - start_time
+    await cog.roles.join()
+    elapsed = time.monotonic() - start_time
+    cog.cog_unload()
+    await cog.closing
+
+    progress = cog.roles.progress()
+    return {
+        'command': args.command,
+        'members': args.members,
+        'workers': args.workers,
+        'command_seconds': round(command_seconds, 3),
+        'seconds': round(elapsed, 3),
+        'role_changes_per_second': round(progress['sent'] / max(elapsed, 1e-9), 1),
+        'dispatcher': progress,
+        'requests': api.requests,
+        'rate_limited': api.rate_limited,
+        'rate_limit_seconds': {key[0]: round(value, 3) for key, value in metrics.DISCORD_RATE_LIMIT_SECONDS._series.items()},
+        'forbidden': api.forbidden,
+        # one call from its first attempt to its success, and the time from the command start until it was done
+        'role_latency': summarize(api.latencies.get('roles', [])),
+        'role_completion': summarize([done - start_time for done in api.completed.get('roles', [])]),
+        'dm_latency': summarize(api.latencies.get('dm', [])),
+    }
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--command', choices=COMMANDS, default='grant_all', help='Mass command to run')
+    parser.add_argument('-m', '--members', type=int, default=2000, help='Number of guild members')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Role dispatcher workers')
+    parser.add_argument('--latency', type=float, default=0.02, help='Mean seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Standard deviation of the request latency')
+    parser.add_argument('--role-limit', type=int, default=50, help='Role changes per window and guild')
+    parser.add_argument('--role-per', type=float, default=1.0, help='Seconds of a role change window')
+    parser.add_argument('--dm-limit', type=int, default=5, help='DMs per window and channel')
+    parser.add_argument('--dm-per', type=float, default=5.0, help='Seconds of a DM window')
+    parser.add_argument('--closed-dms', type=float, default=0.1, help='Share of members with closed DMs')
+    parser.add_argument('--max-p99', type=float, help='Fail when the p99 role completion takes longer than this many seconds')
+    parser.add_argument('--min-throughput', type=float, help='Fail below this many role changes per second')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        # the engine is bound to DATABASE_FILE when operations is imported
+        os.environ['DATABASE_FILE'] = os.path.join(folder, 'database.db')
+        result = asyncio.run(run(args))
+    print(json.dumps(result))
+
+    failures = []
+    if args.max_p99 is not None and (result['role_completion']['p99'] or 0) > args.max_p99:
+        failures.append(f"p99 role completion {result['role_completion']['p99']}s > {args.max_p99}s")
+    if args.min_throughput is not None and result['role_changes_per_second'] < args.min_throughput:
+        failures.append(f"{result['role_changes_per_second']} role changes/s < {args.min_throughput}")
+    if result['dispatcher']['failed']:
+        failures.append(f"{result['dispatcher']['failed']} role changes failed")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,253 @@
+# Drives the VIPCommand coroutines against a seeded database and a fake guild of 1k, 10k and 100k members, recording
+# wall time, SQL statements and peak Python memory (tracemalloc) of every command. The JSON output can be compared across commits.
+# Statement shapes a command repeats more than N_PLUS_ONE_THRESHOLD times are listed as suspected N+1 queries.
+# usage: python benchmarks/suite.py --sizes 1000 10000 --output before.json
+#        python benchmarks/suite.py --output after.json --compare before.json
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+from fakes import FakeDiscordAPI, FakeGuild, FakeMember, FakeBot, FakeContext, VIP_ROLE, ADMIN_ROLE, OWNER_ROLE
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_FOLDER = os.path.join(ROOT_FOLDER, 'bot')
+ADMIN_UID = 1
+FIRST_MEMBER_UID = 1000
+# /redeem is measured with this many members redeeming their own code at the same time
+REDEEMERS = 1000
+BENCHMARKS = ['check_subscriptions', 'grant_all', 'revoke_all', 'list_users', 'free_users', 'redeem']
+# commands that still query per member are only run up to their size here, they take many minutes beyond
+MAX_SIZES = {}
+
+
+def date_string(date: datetime) -> str:
+    return date.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def seed(database: str, size: int) -> list[tuple[int, bool]]:
+    # 80% of the members are registered, 30% of those subscribed (some ending within a day), 20% expired.
+    # Nearly every subscriber has the VIP role and a few members without a subscription still have it.
+    rng = random.Random(42)
+    now = datetime.now()
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO sub_durations (duration, unit) VALUES (1, 'month')")
+    conn.execute('INSERT INTO users (discord_uid, username) VALUES (?, ?)', (ADMIN_UID, 'admin#0001'))
+    members = [FIRST_MEMBER_UID + number for number in range(size)]
+    registered = [discord_uid for discord_uid in members if rng.random() < 0.8]
+    conn.executemany('INSERT INTO users (discord_uid, username) VALUES (?, ?)', ((discord_uid, f'member{discord_uid}#0001') for discord_uid in registered))
+    user_ids = dict(conn.execute('SELECT discord_uid, id FROM users'))
+
+    subscriptions, subscribed = [], set()
+    for discord_uid in registered:
+        draw = rng.random()
+        if draw < 0.3:
+            subscriptions.append((date_string(now - timedelta(days=10)), date_string(now + timedelta(days=rng.uniform(0.5, 30))), user_ids[discord_uid]))
+            subscribed.add(discord_uid)
+        elif draw < 0.5:
+            subscriptions.append((date_string(now - timedelta(days=40)), date_string(now - timedelta(days=rng.uniform(1, 10))), user_ids[discord_uid]))
+    conn.executemany('INSERT INTO subscriptions (start_date, end_date, user_id, active) VALUES (?, ?, ?, 1)', subscriptions)
+
+    codes = [(f'BENCH-{number:06d}', date_string(now + timedelta(days=7)), user_ids[ADMIN_UID]) for number in range(min(size, REDEEMERS))]
+    conn.executemany('INSERT INTO unique_codes (code, redeemed, expiry_date, duration_id, admin_id) VALUES (?, 0, ?, 1, ?)', codes)
+    # the benchmark should not pay for the journal of its own seed data
+    conn.execute('DELETE FROM change_journal')
+    conn.commit()
+    conn.close()
+    return [(discord_uid, rng.random() < (0.95 if discord_uid in subscribed else 0.02)) for discord_uid in members]
+
+
+def build_guild(members: list[tuple[int, bool]], api: FakeDiscordAPI = None) -> tuple[FakeGuild, FakeBot, FakeMember]:
+    guild = FakeGuild(api=api)
+    admin = guild.add_member(ADMIN_UID, 'admin', roles=[ADMIN_ROLE, OWNER_ROLE], administrator=True)
+    bot_user = guild.add_member(2, 'hermes', bot=True)
+    for discord_uid, vip in members:
+        guild.add_member(discord_uid, f'member{discord_uid}', roles=[VIP_ROLE] if vip else [])
+    # ADMIN_USER_ID as fetched by the bot, kept apart from the guild admin so it only collects error reports
+    owner = FakeMember(guild, ADMIN_UID, 'admin')
+    return guild, FakeBot(guild, bot_user, owner), admin
+
+
+
+
+async def invoke(cog, ctx, command, *args) -> None:
+    # what pycord does around a slash command callback, the hooks time it and attribute its statements
+    await cog.cog_before_invoke(ctx)
+    try:
+        await command.callback(cog, ctx, *args)
+    finally:
+        await cog.cog_after_invoke(ctx)
+
+
+async def bench_check_subscriptions(cog, bot, admin) -> dict:
+    checked, updated, timings = await cog.check_subscriptions()
+    return {'checked': checked, 'updated': updated}
+
+
+async def bench_grant_all(cog, bot, admin) -> dict:
+    await invoke(cog, FakeContext(bot, admin, 'grantall'), cog.grant_all, '1m')
+    return {}
+
+
+async def bench_revoke_all(cog, bot, admin) -> dict:
+    cog.role_change_mode = True
+    await invoke(cog, FakeContext(bot, admin, 'revokeall'), cog.revoke_all, '', '')
+    return {}
+
+
+async def bench_list_users(cog, bot, admin) -> dict:
+    ctx = FakeContext(bot, admin, 'listu')
+    await invoke(cog, ctx, cog.list_users)
+    files = [file for response in ctx.responses for file in response.get('files', [])]
+    return {'files': len(files), 'bytes': sum(file.fp.seek(0, os.SEEK_END) for file in files)}
+
+
+async def bench_free_users(cog, bot, admin) -> dict:
+    ctx = FakeContext(bot, admin, 'listfu')
+    await invoke(cog, ctx, cog.free_users_info, False, False)
+    return {}
+
+
+async def bench_redeem(cog, bot, admin) -> dict:
+    members = [member for member in bot.guilds[0].members if not member.bot and not member.guild_permissions.administrator][:REDEEMERS]
+    contexts = [FakeContext(bot, member, 'redeem') for member in members]
+    await asyncio.gather(*[invoke(cog, ctx, cog.redeem_code, f'BENCH-{number:06d}') for number, ctx in enumerate(contexts)])
+    return {'redeemers': len(contexts), 'redeemed': sum(1 for ctx in contexts for response in ctx.responses if response['embed'].title in ('Activation', 'Extension'))}
+
+
+async def run_benchmark(name: str, size: int, memory: bool) -> dict:
+    # runs in its own process: the engine is bound to DATABASE_FILE when operations is imported
+    sys.path.insert(0, BOT_FOLDER)
+    os.environ.setdefault('ADMIN_USER_ID', str(ADMIN_UID))
+    from sqlalchemy import event
+    import operations as ops
+    import metrics
+    from cogs.vipcog import VIPCommand
+
+    ops.init_db()
+    seed_start_time = time.perf_counter()
+    guild, bot, admin = build_guild(seed(ops.DATABASE_FILE, size))
+    seed_seconds = time.perf_counter() - seed_start_time
+    cog = VIPCommand(bot)
+
+    statements = [0]
+    event.listen(ops.async_engine.sync_engine, 'before_cursor_execute', lambda *args: statements.__setitem__(0, statements[0] + 1))
+    invocations = []
+    metrics.invocation_listeners.append(invocations.append)
+    if memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    details = await globals()[f'bench_{name}'](cog, bot, admin)
+    elapsed = time.perf_counter() - start_time
+    await cog.roles.join()
+    drained = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    tracemalloc.stop()
+    cog.cog_unload()
+    await cog.closing
+    # the worst count of every shape over the benchmark's command runs
+    suspected = {}
+    for invocation in invocations:
+        for shape, count in invocation.suspected_n_plus_one().items():
+            suspected[shape] = max(count, suspected.get(shape, 0))
+
+    return {
+        'benchmark': name,
+        'size': size,
+        'seconds': round(elapsed, 3),
+        'roles_drained_seconds': round(drained, 3),
+        'statements': statements[0],
+        'db_seconds': round(sum(invocation.seconds for invocation in invocations), 3),
+        'invocations': len(invocations),
+        'suspected_n_plus_one': suspected,
+        'peak_memory_mib': round(peak / 1024 / 1024, 2) if memory else None,
+        'seed_seconds': round(seed_seconds, 3),
+        # errors end up with the owner through send_private_error_notification
+        'errors': len(bot.owner.messages),
+        'role_changes': cog.roles.sent,
+        **details,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base: dict, results: list[dict]) -> None:
+    previous = {(result['benchmark'], result['size']): result for result in base['results']}
+    print(f"compared with {base.get('commit')}:")
+    for result in results:
+        old = previous.get((result['benchmark'], result['size']))
+        if old is None:
+            continue
+        changes = [f"{key} {old[key]} -> {result[key]} ({result[key] / old[key]:.2f}x)" for key in ('seconds', 'statements', 'peak_memory_mib') if old.get(key) and result.get(key) is not None]
+        print(f"{result['benchmark']} @ {result['size']}: {', '.join(changes)}")
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Guild sizes to benchmark')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('-c', '--compare', type=str, help='Compare with the results of an earlier run')
+    parser.add_argument('--fail-on-n-plus-one', action='store_true', help='Exit with an error when a command repeats a statement shape more than N_PLUS_ONE_THRESHOLD times')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced run that measures peak memory')
+    parser.add_argument('--run', choices=BENCHMARKS, help='Run a single benchmark in this process (used internally)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.run:
+        print(json.dumps(asyncio.run(run_benchmark(args.run, args.sizes[0], not args.no_memory))))
+        sys.exit()
+
+    results = []
+    for size in args.sizes:
+        for name in args.benchmarks:
+            if size > MAX_SIZES.get(name, size):
+                continue
+            # tracemalloc slows the commands down several times, so the peak memory comes from a second, traced run.
+            # Every run gets a freshly seeded database
+            runs = []
+            for memory in [False] if args.no_memory else [False, True]:
+                with tempfile.TemporaryDirectory() as folder:
+                    env = dict(os.environ, DATABASE_FILE=os.path.join(folder, 'database.db'))
+                    command = [sys.executable, __file__, '--run', name, '--sizes', str(size)] + ([] if memory else ['--no-memory'])
+                    output = subprocess.run(command, env=env, capture_output=True, text=True)
+                if output.returncode != 0:
+                    print(f'{name} @ {size} failed:\n{output.stderr}', file=sys.stderr)
+                    break
+                runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+            else:
+                results.append(runs[0])
+                if len(runs) > 1:
+                    results[-1]['peak_memory_mib'] = runs[1]['peak_memory_mib']
+                print(json.dumps(results[-1]))
+
+    report = {'commit': get_commit(), 'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    failed = any(result['errors'] for result in results) or len(results) < sum(1 for size in args.sizes for name in args.benchmarks if size <= MAX_SIZES.get(name, size))
+    if args.fail_on_n_plus_one:
+        for result in results:
+            for shape, count in result['suspected_n_plus_one'].items():
+                print(f"{result['benchmark']} @ {result['size']}: suspected N+1, {count} x {shape}", file=sys.stderr)
+                failed = True
+    sys.exit(1 if failed else 0)
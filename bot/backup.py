@@ -1,11 +1,39 @@
 import csv
+import gzip
+import hashlib
+import json
 import sqlite3
+import tempfile
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
 import os
 
 BACKUP_FOLDER = 'backup'
+DATABASE_FILE = os.environ.get('DATABASE_FILE', 'database.db')
+# last change journal seq that was exported, incremental exports continue after it
+JOURNAL_CHECKPOINT = 'journal_checkpoint'
+JOURNAL_HEADERS = ['seq', 'table_name', 'op', 'row_id', 'row_data', 'changed_at']
+# holds the journal seq a restored database has the changes up to, it belongs to the database and is never exported
+JOURNAL_STATE = 'journal_state'
+# rows held in memory at a time by the export and restore
+BATCH_SIZE = 10000
+MANIFEST_FILE = 'manifest.json'
 
 def main(args: ArgumentParser):
+    if args.incremental:
+        export_journal()
+        return
+    if args.replay is not None:
+        replay_journal(args.replay, args.until_seq, args.until_time)
+        return
+    if args.prune:
+        prune_journal()
+        return
+
     if args.all:
         tables = list_tables()
         if args.exclude_tables:
@@ -14,11 +42,11 @@ def main(args: ArgumentParser):
         tables = args.tables
 
     if args.backup:
-        data = fetch_data(tables)
-        write_csvs(data)
+        export_tables(tables, args.jobs, args.compress)
     elif args.restore:
-        data = read_csvs(tables)
-        insert_data(data)
+        restore_tables(tables)
+    elif args.fast_restore:
+        fast_restore(tables)
     elif args.delete:
         delete_data(tables)
     elif args.list:
@@ -28,49 +56,296 @@ def main(args: ArgumentParser):
         print('No action specified')
 
 
-def write_csvs(data: dict[str, list[list[str]]]) -> None:
-    print("Writing CSVs...")
-    for table_name, data in data.items():
-        with open(f'{BACKUP_FOLDER}{os.sep}{table_name}.csv', 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(data)
-    print("CSVs written")
+def export_tables(tables: list[str], jobs: int = 1, compress: bool = False) -> None:
+    # every table is streamed into its CSV file in batches, all of them from the same snapshot. With more than one job the
+    # tables are exported by parallel processes from a copy of the database, separate connections can not share a snapshot
+    print("Exporting tables...")
+    # clean table names to prevent SQL injection
+    tables = [process_name(table) for table in tables]
+    # more processes than tables or cores only add overhead
+    jobs = min(jobs, len(tables), os.cpu_count() or 1)
+    start_time = time.time()
+    try:
+        if jobs > 1:
+            with tempfile.TemporaryDirectory(dir=BACKUP_FOLDER) as folder:
+                snapshot = os.path.join(folder, 'snapshot.db')
+                copy_snapshot(DATABASE_FILE, snapshot)
+                print(f"Snapshot taken in {round(time.time() - start_time, 2)}s")
+                conn = sqlite3.connect(snapshot)
+                try:
+                    journal_seq = get_journal_seq(conn)
+                finally:
+                    conn.close()
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    results = list(executor.map(export_table_from, [snapshot] * len(tables), tables, [compress] * len(tables)))
+        else:
+            conn = sqlite3.connect(DATABASE_FILE, isolation_level=None)
+            try:
+                conn.execute('BEGIN')
+                journal_seq = get_journal_seq(conn)
+                results = [export_table(conn, table, compress) for table in tables]
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+    except Exception as e:
+        print(e)
+        return
 
+    for result in results:
+        print_rate(result['table'], result['rows'], result['seconds'])
+    write_manifest(results, journal_seq)
+    print_rate('Tables exported', sum(result['rows'] for result in results), time.time() - start_time)
 
-def read_csvs(tables: list[str]) -> dict[str, list[list[str]]]:
-    print("Reading CSVs...")
-    data = {}
-    for table in tables:
-        with open(f'{BACKUP_FOLDER}{os.sep}{table}.csv', 'r') as f:
-            reader = csv.reader(f)
-            data[table] = list(reader)
-    print("CSVs read")
-    return data
 
+def copy_snapshot(source_database: str, snapshot: str) -> None:
+    source = sqlite3.connect(source_database)
+    destination = sqlite3.connect(snapshot)
+    try:
+        source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
 
-def fetch_data(tables: list[str]) -> dict[str, list[list[str]]]:
-    print("Fetching data...")
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+
+def export_table_from(database: str, table: str, compress: bool) -> dict:
+    # runs in a worker process, on its own read-only connection
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
     try:
-        data = {}
-        for table in tables:
-            # clean table name to prevent SQL injection
-            table = process_name(table)
-            query = f'SELECT * FROM {table}'
-            cursor.execute(query)
-            data[table] = cursor.fetchall()
-        print("Data fetched")
-        return data
+        return export_table(conn, table, compress)
+    finally:
+        conn.close()
+
+
+def export_table(conn: sqlite3.Connection, table: str, compress: bool) -> dict:
+    table_rows, start_time = 0, time.time()
+    path = f'{BACKUP_FOLDER}{os.sep}{table}.csv' + ('.gz' if compress else '')
+    cursor = conn.execute(f'SELECT * FROM {table}')
+    with (gzip.open(path, 'wt', newline='', compresslevel=6) if compress else open(path, 'w', newline='')) as f:
+        writer = csv.writer(f)
+        while rows := cursor.fetchmany(BATCH_SIZE):
+            writer.writerows(rows)
+            table_rows += len(rows)
+    return {'table': table, 'file': os.path.basename(path), 'rows': table_rows, 'bytes': os.path.getsize(path), 'sha256': file_sha256(path), 'seconds': time.time() - start_time}
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_manifest(results: list[dict], journal_seq: int) -> None:
+    manifest = {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'database': DATABASE_FILE,
+        # the export holds every change up to this journal seq, a replay continues after it
+        'journal_seq': journal_seq,
+        'tables': {result['table']: {key: value for key, value in result.items() if key not in ['table', 'seconds']} for result in results},
+    }
+    with open(f'{BACKUP_FOLDER}{os.sep}{MANIFEST_FILE}', 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def restore_tables(tables: list[str]) -> None:
+    # streams the CSV files back with executemany in batches, the INSERT of a table is prepared once and reused from
+    # the statement cache. Everything is restored in one transaction
+    print("Restoring tables...")
+    manifest = read_manifest()
+    if not verify_checksums(tables, manifest):
+        return
+    conn = sqlite3.connect(DATABASE_FILE, isolation_level=None)
+    try:
+        conn.execute('BEGIN')
+        total_rows, start_time = 0, time.time()
+        with journal_triggers_dropped(conn):
+            for table in tables:
+                table = process_name(table)
+                table_start_time = time.time()
+                table_rows = load_table(conn, table, get_table_file(table, manifest))
+                print_rate(table, table_rows, time.time() - table_start_time)
+                total_rows += table_rows
+        set_applied_seq(conn, read_manifest_journal_seq())
+        conn.execute('COMMIT')
+        print_rate('Tables restored', total_rows, time.time() - start_time)
     except Exception as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
         print(e)
     finally:
         conn.close()
 
 
+def load_table(conn: sqlite3.Connection, table: str, path: str) -> int:
+    # the INSERT of a table is prepared once and reused from the statement cache for every batch
+    table_rows = 0
+    # the CSV writer exports NULL as an empty field, in nullable columns it is read back as NULL
+    nullable = [not notnull for cid, name, type, notnull, default, pk in conn.execute(f'PRAGMA main.table_info({table})')]
+    with (gzip.open(path, 'rt', newline='') if path.endswith('.gz') else open(path, 'r', newline='')) as f:
+        reader = csv.reader(f)
+        while rows := list(islice(reader, BATCH_SIZE)):
+            rows = [[None if value == '' and null else value for value, null in zip(row, nullable)] for row in rows]
+            query = f'INSERT INTO {table} VALUES ({",".join(["?"] * len(rows[0]))})'
+            conn.executemany(query, rows)
+            table_rows += len(rows)
+    return table_rows
+
+
+def fast_restore(tables: list[str]) -> None:
+    # builds a new database file next to the current one and swaps it in when it is complete, the bot must be stopped.
+    # The schema comes from the current database: tables first, indexes and triggers once the data is in, so the load
+    # neither maintains indexes nor journals. The new file has no rollback journal and is not synced while it is built,
+    # which is safe because a failed load only leaves a temporary file behind
+    print("Fast restoring tables...")
+    manifest = read_manifest()
+    if not verify_checksums(tables, manifest):
+        return
+    if not os.path.exists(DATABASE_FILE):
+        print(f"{DATABASE_FILE} not found, its schema is needed to restore into")
+        return
+    tables = [process_name(table) for table in tables]
+    folder = os.path.dirname(os.path.abspath(DATABASE_FILE))
+    fd, restore_file = tempfile.mkstemp(prefix='restore_', suffix='.db', dir=folder)
+    os.close(fd)
+    conn = sqlite3.connect(restore_file, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.execute(f"ATTACH DATABASE 'file:{DATABASE_FILE}?mode=ro' AS current")
+        schema = conn.execute("SELECT type, name, sql FROM current.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+        user_version = conn.execute('PRAGMA current.user_version').fetchone()[0]
+
+        total_rows, start_time = 0, time.time()
+        conn.execute('BEGIN')
+        for kind, name, sql in schema:
+            if kind == 'table':
+                conn.execute(sql)
+        for kind, name, sql in schema:
+            if kind != 'table':
+                continue
+            table_start_time = time.time()
+            if name in tables:
+                table_rows = load_table(conn, name, get_table_file(name, manifest))
+            else:
+                # tables that are not restored keep their current rows
+                table_rows = conn.execute(f'INSERT INTO main.{name} SELECT * FROM current.{name}').rowcount
+            print_rate(name, table_rows, time.time() - table_start_time)
+            total_rows += table_rows
+        copy_sequences(conn)
+        conn.execute('COMMIT')
+        print_rate('Tables loaded', total_rows, time.time() - start_time)
+
+        index_start_time = time.time()
+        conn.execute('BEGIN')
+        for kind, name, sql in schema:
+            if kind in ('index', 'trigger', 'view'):
+                conn.execute(sql)
+        conn.execute(f'PRAGMA user_version = {user_version}')
+        set_applied_seq(conn, read_manifest_journal_seq())
+        conn.execute('COMMIT')
+        print(f"Indexes and triggers created in {round(time.time() - index_start_time, 2)}s")
+
+        violations = conn.execute('PRAGMA foreign_key_check').fetchall()
+        if violations:
+            print(f"{len(violations)} foreign key violations, first ones (table, rowid, parent, fk): {violations[:5]}")
+            print("Nothing restored")
+            return
+        conn.execute('DETACH DATABASE current')
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+
+        if not checkpoint_database(DATABASE_FILE):
+            print(f"{DATABASE_FILE} is in use, stop the bot before restoring. Nothing restored")
+            return
+        os.replace(restore_file, DATABASE_FILE)
+        print_rate('Tables restored', total_rows, time.time() - start_time)
+    except Exception as e:
+        print(e)
+    finally:
+        conn.close()
+        if os.path.exists(restore_file):
+            os.remove(restore_file)
+
+
+def copy_sequences(conn: sqlite3.Connection) -> None:
+    # sqlite_sequence is not part of the copied schema, without it AUTOINCREMENT counters restart at the highest restored id.
+    # The journal seq must never go back, or incremental exports skip the changes below their checkpoint
+    if not conn.execute("SELECT 1 FROM current.sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+        return
+    sequences = dict(conn.execute('SELECT name, seq FROM main.sqlite_sequence'))
+    for name, seq in conn.execute('SELECT name, seq FROM current.sqlite_sequence'):
+        sequences[name] = max(seq, sequences.get(name, 0))
+    conn.execute('DELETE FROM main.sqlite_sequence')
+    conn.executemany('INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)', sequences.items())
+
+
+def checkpoint_database(database: str) -> bool:
+    # a WAL file left next to the swapped in file would be replayed onto it, so its content must be in the old file
+    # and the WAL gone before the swap
+    conn = sqlite3.connect(database)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        # the mode does not change while another connection is in a transaction, the old one is returned then. Idle
+        # connections hold no lock and cannot be detected, which is why the bot has to be stopped
+        journal_mode = conn.execute('PRAGMA journal_mode = DELETE').fetchone()[0]
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+    return journal_mode == 'delete' and not os.path.exists(f'{database}-wal')
+
+
+def verify_checksums(tables: list[str], manifest: dict) -> bool:
+    for table in tables:
+        if table in manifest and file_sha256(get_table_file(table, manifest)) != manifest[table]['sha256']:
+            print(f"Checksum of {get_table_file(table, manifest)} does not match the manifest, nothing restored")
+            return False
+    return True
+
+
+def read_manifest() -> dict:
+    # table -> {file, rows, bytes, sha256} of the last export, empty for exports made before there was a manifest
+    path = f'{BACKUP_FOLDER}{os.sep}{MANIFEST_FILE}'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)['tables']
+
+
+def read_manifest_journal_seq() -> int:
+    # exports made before the manifest recorded it are treated as holding no changes, a replay then starts from the beginning
+    path = f'{BACKUP_FOLDER}{os.sep}{MANIFEST_FILE}'
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r') as f:
+        return json.load(f).get('journal_seq') or 0
+
+
+def get_table_file(table: str, manifest: dict) -> str:
+    return f'{BACKUP_FOLDER}{os.sep}' + (manifest[table]['file'] if table in manifest else f'{table}.csv')
+
+
+@contextmanager
+def journal_triggers_dropped(conn: sqlite3.Connection):
+    # rows written back from a backup already have their journal entries, the triggers would add a second copy.
+    # Must run inside the caller's transaction, so the triggers are never missing for other connections
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'journal_%'").fetchall()
+    for name, sql in triggers:
+        conn.execute(f'DROP TRIGGER {name}')
+    yield
+    for name, sql in triggers:
+        conn.execute(sql)
+
+
+def print_rate(name: str, rows: int, seconds: float) -> None:
+    print(f"{name}: {rows} rows in {round(seconds, 2)}s ({round(rows / max(seconds, 1e-9))} rows/s)")
+
+
 def delete_data(tables: list[str]) -> None:
     print("Deleting data...")
-    conn = sqlite3.connect('database.db')
+    conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     try:
         for table in tables:
@@ -86,11 +361,11 @@ def delete_data(tables: list[str]) -> None:
 
 
 def list_tables() -> list[str]:
-    conn = sqlite3.connect('database.db')
+    conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     try:
-        query = "SELECT name FROM sqlite_schema WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
-        cursor.execute(query)
+        query = "SELECT name FROM sqlite_schema WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != ?"
+        cursor.execute(query, (JOURNAL_STATE,))
         tables = cursor.fetchall()
         tables = [table[0] for table in tables]
         return tables
@@ -100,18 +375,141 @@ def list_tables() -> list[str]:
         conn.close()
 
 
-def insert_data(data: dict[str, list[list[str]]]) -> None:
-    print("Inserting data...")
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+def read_checkpoint() -> int:
+    path = f'{BACKUP_FOLDER}{os.sep}{JOURNAL_CHECKPOINT}'
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r') as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(seq: int) -> None:
+    path = f'{BACKUP_FOLDER}{os.sep}{JOURNAL_CHECKPOINT}'
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(str(seq))
+    os.replace(f'{path}.tmp', path)
+
+
+def get_journal_seq(conn: sqlite3.Connection) -> int:
+    # the last seq handed out, unlike MAX(seq) it survives pruning
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+        return 0
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+    return row[0] if row else 0
+
+
+def get_applied_seq(conn: sqlite3.Connection) -> int:
+    # a restored (or replayed) database knows its seq from journal_state, any other one has every change it journaled
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (JOURNAL_STATE,)).fetchone():
+        row = conn.execute(f'SELECT applied_seq FROM {JOURNAL_STATE} WHERE id = 1').fetchone()
+        if row:
+            return row[0]
+    return get_journal_seq(conn)
+
+
+def set_applied_seq(conn: sqlite3.Connection, seq: int) -> None:
+    conn.execute(f'INSERT INTO {JOURNAL_STATE} (id, applied_seq) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET applied_seq = excluded.applied_seq', (seq,))
+
+
+def export_journal() -> str:
+    # writes the journal entries after the checkpoint to journal_<first seq>_<last seq>.csv and moves the checkpoint
+    print("Exporting change journal...")
+    checkpoint = read_checkpoint()
+    temp_file = f'{BACKUP_FOLDER}{os.sep}journal.csv.tmp'
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        # a journal behind the checkpoint was reset (e.g. by a restore that lost the sequence), its new changes
+        # would be taken for exported ones and left out of every incremental backup
+        journal_seq = get_journal_seq(conn)
+        if journal_seq < checkpoint:
+            raise SystemExit(f"Change journal is at seq {journal_seq}, behind the checkpoint {checkpoint}. Take a full backup (-b -a) and remove {BACKUP_FOLDER}{os.sep}{JOURNAL_CHECKPOINT}")
+        cursor = conn.execute('SELECT seq, table_name, op, row_id, row_data, changed_at FROM change_journal WHERE seq > ? ORDER BY seq', (checkpoint,))
+        first_seq = last_seq = None
+        count = 0
+        with open(temp_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(JOURNAL_HEADERS)
+            while rows := cursor.fetchmany(1000):
+                writer.writerows(rows)
+                first_seq = first_seq or rows[0][0]
+                last_seq = rows[-1][0]
+                count += len(rows)
+    finally:
+        conn.close()
+
+    if count == 0:
+        os.remove(temp_file)
+        print(f"No changes since seq {checkpoint}")
+        return None
+    journal_file = f'{BACKUP_FOLDER}{os.sep}journal_{first_seq:012d}_{last_seq:012d}.csv'
+    os.replace(temp_file, journal_file)
+    write_checkpoint(last_seq)
+    print(f"Exported {count} changes (seq {first_seq} to {last_seq}) to {journal_file}")
+    return journal_file
+
+
+def replay_journal(journal_files: list[str], until_seq: int = None, until_time: str = None) -> int:
+    # applies journal files on top of a restored backup, in seq order and in one transaction. Entries the database already
+    # holds are skipped, until_seq / until_time stop the replay at a point in time
+    journal_files = sorted(journal_files or [f'{BACKUP_FOLDER}{os.sep}{name}' for name in os.listdir(BACKUP_FOLDER) if name.startswith('journal_') and name.endswith('.csv')])
+    print(f"Replaying {len(journal_files)} journal files...")
+    conn = sqlite3.connect(DATABASE_FILE, isolation_level=None)
+    try:
+        tables = set(list_tables())
+        # not MAX(seq) of the journal, which drops with pruning and does not say what a restored database holds
+        applied_seq = get_applied_seq(conn)
+        conn.execute('BEGIN')
+        count = 0
+        # replayed rows keep their original journal entries
+        with journal_triggers_dropped(conn):
+            for journal_file in journal_files:
+                with open(journal_file, 'r', newline='') as f:
+                    reader = csv.reader(f)
+                    next(reader)
+                    for seq, table_name, op, row_id, row_data, changed_at in reader:
+                        if int(seq) <= applied_seq:
+                            continue
+                        if (until_seq and int(seq) > until_seq) or (until_time and changed_at > until_time):
+                            break
+                        if table_name not in tables:
+                            raise ValueError(f'Unknown table {table_name} at seq {seq}')
+                        apply_change(conn, table_name, op, int(row_id), row_data)
+                        conn.execute('INSERT OR IGNORE INTO change_journal (seq, table_name, op, row_id, row_data, changed_at) VALUES (?, ?, ?, ?, ?, ?)', (int(seq), table_name, op, int(row_id), row_data or None, changed_at))
+                        applied_seq = int(seq)
+                        count += 1
+        set_applied_seq(conn, applied_seq)
+        conn.execute('COMMIT')
+        print(f"Replayed {count} changes, database is at seq {applied_seq}")
+        return count
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        print(e)
+    finally:
+        conn.close()
+
+
+def apply_change(conn: sqlite3.Connection, table_name: str, op: str, row_id: int, row_data: str) -> None:
+    if op == 'D':
+        conn.execute(f'DELETE FROM {table_name} WHERE id = ?', (row_id,))
+        return
+    row = json.loads(row_data)
+    columns = [process_name(column) for column in row]
+    assignments = ', '.join(f'{column} = excluded.{column}' for column in columns)
+    conn.execute(
+        f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({", ".join(["?"] * len(columns))}) ON CONFLICT(id) DO UPDATE SET {assignments}',
+        list(row.values()),
+    )
+
+
+def prune_journal() -> None:
+    # drops the entries that were already exported
+    checkpoint = read_checkpoint()
+    conn = sqlite3.connect(DATABASE_FILE)
     try:
-        for table_name, table_data in data.items():
-            table_name = process_name(table_name)
-            for row in table_data:
-                query = f'INSERT INTO {table_name} VALUES ({",".join(["?"] * len(row))})'
-                cursor.execute(query, row)
+        deleted = conn.execute('DELETE FROM change_journal WHERE seq <= ?', (checkpoint,)).rowcount
         conn.commit()
-        print("Data inserted")
+        print(f"Pruned {deleted} journal entries up to seq {checkpoint}")
     except Exception as e:
         print(e)
     finally:
@@ -140,6 +538,15 @@ def parse_args():
     parser.add_argument('-a', '--all', action='store_true', help='Backup or restore all tables') # use if args.all
     parser.add_argument('-l', '--list', action='store_true', help='List all tables') # use if args.list
     parser.add_argument('-d', '--delete', action='store_true', help='Delete all tables') # use if args.delete
+    parser.add_argument('-db', '--database', type=str, default=DATABASE_FILE, help='Database file')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Export the changes since the last incremental export')
+    parser.add_argument('-rp', '--replay', type=str, nargs='*', help='Replay journal files (all in the backup folder when none given) on the database')
+    parser.add_argument('-us', '--until-seq', type=int, help='Stop the replay after this journal seq')
+    parser.add_argument('-ut', '--until-time', type=str, help='Stop the replay after this time (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Export this many tables in parallel')
+    parser.add_argument('-z', '--compress', action='store_true', help='Gzip the exported CSV files')
+    parser.add_argument('-fr', '--fast-restore', action='store_true', help='Restore into a new database file and swap it in, the bot must be stopped')
+    parser.add_argument('-p', '--prune', action='store_true', help='Delete the journal entries that were already exported')
     # parser.add_argument('-ac', '--add-column', type=str, help='Add a column to a csv file with default value')
     # parser.add_argument('-dc', '--delete-column', type=str, help='Delete a column from a csv file')
     # parser.add_argument('-cp', '--column-position', type=int, help='Position of column to change')
@@ -148,6 +555,7 @@ def parse_args():
 
 if __name__ == '__main__':
     args = parse_args()
+    DATABASE_FILE = args.database
     if not os.path.exists(BACKUP_FOLDER):
         os.makedirs(BACKUP_FOLDER)
     main(args)
\ No newline at end of file
@@ -14,10 +14,24 @@ import io
 import operations as ops
 import models as mdls
 import utils as utls
+from scheduler import Scheduler
+from dispatcher import RoleDispatcher
+from digest import AdminDigest
+from exports import export_csv, MAX_FILES_PER_MESSAGE
+import metrics
 
 load_dotenv()
 
 ADMIN_USER_ID = os.environ['ADMIN_USER_ID']
+MAX_GENERATED_CODES = 10000
+CODE_PURGE_INTERVAL_HOURS = float(os.environ.get('CODE_PURGE_INTERVAL_HOURS', 6))
+CODE_PURGE_MAX_ROWS = int(os.environ.get('CODE_PURGE_MAX_ROWS', 50000))
+ROLE_DISPATCH_WORKERS = int(os.environ.get('ROLE_DISPATCH_WORKERS', 4))
+ADMIN_DIGEST_WINDOW = float(os.environ.get('ADMIN_DIGEST_WINDOW', 300))
+FREE_TRIAL_DURATION = timedelta(minutes=20)
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', 24))
+# safety net behind the scheduler: reinstates members who rejoined and catches anything missed while disabled
+RECONCILE_INTERVAL_HOURS = float(os.environ.get('RECONCILE_INTERVAL_HOURS', 12))
 
 class NewMemberButtonsView(discord.ui.View):
     @discord.ui.button(label='Grant', row=0, style=discord.ButtonStyle.primary)
@@ -36,8 +50,21 @@ class VIPCommand(commands.Cog):
         ops.init_db()
         self.bot = bot
         self.bot.remove_command('help')
-        self.perm_vips = {}
-        self.task_check_subscriptions.start()
+        self.scheduler = Scheduler('subscriptions')
+        self.trials = Scheduler('trials')
+        ops.subscription_listeners.append(self.schedule_subscription)
+        self.roles = RoleDispatcher('roles', ROLE_DISPATCH_WORKERS)
+        self.digest = AdminDigest('admins', ADMIN_DIGEST_WINDOW)
+        # discord_uid -> end date a reminder was sent for, the scheduled reminder and the reconcile check both remind
+        self.reminded = {}
+        metrics.SCHEDULER_PENDING.set_function(lambda: len(self.scheduler), scheduler=self.scheduler.name)
+        metrics.SCHEDULER_PENDING.set_function(lambda: len(self.trials), scheduler=self.trials.name)
+        metrics.ROLE_QUEUE.set_function(lambda: len(self.roles))
+        metrics.DIGEST_SAVED.set_function(lambda: self.digest.saved)
+        self.load_scheduler.start()
+        self.reconcile_subscriptions.start()
+        self.purge_expired_codes.start()
+        self.backup_db.start()
         self.sub_check_in_progress = False
         self.backup_in_progress = False
         self.silent = True
@@ -46,31 +73,89 @@ class VIPCommand(commands.Cog):
         
     
     def cog_unload(self):
-        self.task_check_subscriptions.cancel()
-
-    @tasks.loop(hours=12)
-    async def task_check_subscriptions(self):
-        if self.sub_check_mode:
+        self.load_scheduler.cancel()
+        self.reconcile_subscriptions.cancel()
+        self.purge_expired_codes.cancel()
+        self.backup_db.cancel()
+        ops.subscription_listeners.remove(self.schedule_subscription)
+        # py-cord unloads cogs synchronously, whoever unloads this one awaits closing for the schedulers to wind down and
+        # the admin digest to go out
+        self.closing = asyncio.create_task(self.close())
+
+    async def close(self):
+        await asyncio.gather(self.scheduler.stop(), self.trials.stop())
+        # only once no callback is left that could queue a role change, a change queued after stop() restarts the workers
+        self.roles.stop()
+        # last, so the notifications of those callbacks are in the final digest
+        await self.digest.stop()
+
+    async def cog_before_invoke(self, ctx):
+        ctx.metrics_start_time = time.perf_counter()
+        ctx.invocation = metrics.start_invocation(ctx.command.name)
+
+    async def cog_after_invoke(self, ctx):
+        metrics.COMMAND_SECONDS.observe(time.perf_counter() - ctx.metrics_start_time, command=ctx.command.name)
+        metrics.finish_invocation(ctx.invocation)
+
+    @tasks.loop(count=1)
+    @metrics.track_invocation
+    async def load_scheduler(self):
+        # queue the start, expiry (and reminder) of every subscription that has not ended yet, later changes are pushed by ops
+        subscriptions = await ops.get_unexpired_subscriptions()
+        for subscription in subscriptions:
+            self.schedule_subscription(subscription.id, subscription.user_id, subscription.start_date, subscription.end_date)
+        self.scheduler.start()
+        logging.info(f'Scheduler loaded with {len(self.scheduler)} pending subscription events.')
+
+        # free trials survive restarts, the ones that ended while the bot was down expire right away
+        for trial in await ops.get_free_trials():
+            self.trials.schedule(trial.discord_uid, trial.expires_at, self.on_free_trial_expired, trial.discord_uid)
+        self.trials.start()
+        logging.info(f'Scheduler loaded with {len(self.trials)} pending free trials.')
+
+    @tasks.loop(hours=RECONCILE_INTERVAL_HOURS)
+    async def reconcile_subscriptions(self):
+        if self.sub_check_mode and not self.sub_check_in_progress:
             await self.check_subscriptions()
 
-    @tasks.loop(hours=24)
+    @tasks.loop(hours=BACKUP_INTERVAL_HOURS)
+    @metrics.track_invocation
     async def backup_db(self):
+        if self.backup_in_progress:
+            return
         self.backup_in_progress = True
         logging.info('Backing up database...')
-        backup_file, err_msg = await ops.backup_database()
-        self.backup_in_progress = False
+        try:
+            backup_file, stats, err_msg = await ops.backup_database()
+        finally:
+            self.backup_in_progress = False
         if err_msg:
             logging.error(err_msg)
             await self.send_private_error_notification(error_message=err_msg)
             return
-        logging.info(f'Database backed up to {backup_file}')
+        logging.info(f'Database backed up to {backup_file}: {utls.format_backup_stats(stats)}')
 
-    # @tasks.loop(hours=1)
-    # async def check_codes(self):
-    #     pass
+    @tasks.loop(hours=CODE_PURGE_INTERVAL_HOURS)
+    @metrics.track_invocation
+    async def purge_expired_codes(self):
+        start_time = time.time()
+        purged = await ops.delete_expired_unique_codes(CODE_PURGE_MAX_ROWS)
+        logging.info(f'Purged {purged} expired codes in {round(time.time() - start_time, 2)} seconds.')
 
-    @task_check_subscriptions.before_loop
-    async def before_task_check_subscriptions(self):
+    @load_scheduler.before_loop
+    async def before_load_scheduler(self):
+        await self.bot.wait_until_ready()  # wait until the bot logs in
+
+    @reconcile_subscriptions.before_loop
+    async def before_reconcile_subscriptions(self):
+        await self.bot.wait_until_ready()  # wait until the bot logs in
+
+    @purge_expired_codes.before_loop
+    async def before_purge_expired_codes(self):
+        await self.bot.wait_until_ready()  # wait until the bot logs in
+
+    @backup_db.before_loop
+    async def before_backup_db(self):
         await self.bot.wait_until_ready()  # wait until the bot logs in
 
 
@@ -94,7 +179,7 @@ class VIPCommand(commands.Cog):
         embed.add_field(name='/help1', value='Returns the list of Admin commands.', inline=False)
         embed.add_field(name='/help2', value='Returns the list of Advanced Admin commands.', inline=False)
         embed.add_field(name='/ping', value='Returns the latency of the bot.', inline=False)
-        embed.add_field(name='/generate', value='Generates a unique code for a VIP subscription.', inline=False)
+        embed.add_field(name='/generate <duration> <count>', value='Generates unique codes for a VIP subscription. Count is optional, more than one code is sent as a CSV file.', inline=False)
         embed.add_field(name='/grant <@User> <duration>', value='Grants a VIP subscription to a user. Duration is optional.', inline=False)
         embed.add_field(name='/revoke <@User> <duration>', value='Revokes a VIP subscription from a user. Duration is optional.', inline=False)
         embed.add_field(name='/ustatus <@User>', value='Checks the status of a user.', inline=False)
@@ -132,12 +217,13 @@ class VIPCommand(commands.Cog):
         if not self.sub_check_in_progress:
             start_time = time.time()
             await ctx.respond(embed=utls.info_embed('Force checking subscriptions...'))
-            records_checked, records_updated = await self.check_subscriptions()
+            records_checked, records_updated, timings = await self.check_subscriptions()
             end_time = time.time()
             embed=utls.success_embed(f'Force checked all subscriptions successfully.')
             embed.add_field(name='Time spent:', value=f'{round(end_time - start_time, 2)} seconds', inline=False)
+            embed.add_field(name='Time per phase:', value=' / '.join(f'{phase} {round(seconds, 2)}s' for phase, seconds in timings.items()), inline=False)
             embed.add_field(name='Users checked', value=f'{records_checked} users', inline=False)
-            embed.add_field(name='Subscriptions updated', value=f'{records_updated} subscriptions', inline=False)
+            embed.add_field(name='Diff size', value=f'{records_updated} members updated', inline=False)
             await ctx.respond(embed=embed)
         else:
             await ctx.respond(embed=utls.warning_embed('The bot is already checking subscriptions at the moment. Please wait until it finishes.'))
@@ -152,14 +238,23 @@ class VIPCommand(commands.Cog):
             return
         # record time spent backing up database
         if not self.backup_in_progress:
+            self.backup_in_progress = True
             start_time = time.time()
             await ctx.respond(embed=utls.info_embed('Force backing up database...'))
             logging.info('Forcing backup...')
-            await ops.backup_database()
-            logging.info('Backup complete.')
+            try:
+                backup_file, stats, err_msg = await ops.backup_database()
+            finally:
+                self.backup_in_progress = False
             end_time = time.time()
+            if err_msg:
+                logging.error(err_msg)
+                await ctx.respond(embed=utls.error_embed(err_msg))
+                return
+            logging.info(f'Backup complete: {utls.format_backup_stats(stats)}')
             embed=utls.success_embed(f'Force backed up database successfully.')
             embed.add_field(name='Time spent:', value=f'{round(end_time - start_time, 2)} seconds', inline=False)
+            embed.add_field(name='Backup:', value=utls.format_backup_stats(stats), inline=False)
             await ctx.respond(embed=embed)
         else:
             await ctx.respond(embed=utls.warning_embed('The bot is already backing up the database at the moment. Please wait until it finishes.'))
@@ -171,8 +266,8 @@ class VIPCommand(commands.Cog):
 
 
     # @discord.slash_command(name='generate', aliases=['gen', 'forge'], description='Generates a unique code for a VIP subscription.')
-    @discord.slash_command(name='generate', description='Generates a unique code for a VIP subscription.')
-    async def generate_code(self, ctx, duration: str = '1m'):
+    @discord.slash_command(name='generate', description='Generates unique codes for a VIP subscription.')
+    async def generate_code(self, ctx, duration: str = '1m', count: int = 1):
         try:
             # make sure the command is not private
             if ctx.guild is None:
@@ -193,22 +288,42 @@ class VIPCommand(commands.Cog):
                 await ctx.respond(embed=utls.warning_embed(err_msg))
                 return
 
-            # generate a unique code
-            code = await utls.gen_unique_code(12)
+            # check if the count is valid
+            if not 1 <= count <= MAX_GENERATED_CODES:
+                await ctx.respond(embed=utls.warning_embed(f'Invalid count. Between 1 and {MAX_GENERATED_CODES} codes can be generated at once.'))
+                return
+
+            # generate the unique codes
+            codes = await utls.gen_unique_codes(12, count)
 
             # generate an expiry date
             expiry_date = (datetime.now() + timedelta(days=7))
-            
-            # create a new unique code record
-            unique_code = mdls.UniqueCode(code, expiry_date, duration, admin)
 
-            # insert the new unique code record into the database
-            await ops.add_unique_code(unique_code)
+            # insert all the new unique code records into the database at once
+            await ops.add_unique_codes(codes, expiry_date, duration, admin)
 
-            embed = utls.success_embed(title=code, description='This code can be redeemed for a VIP subscription.')
-            embed.add_field(name='Duration:', value=f"{duration.duration} {duration.unit}{'s' if duration.duration > 1 else ''}", inline=False)
+            duration_str = f"{duration.duration} {duration.unit}{'s' if duration.duration > 1 else ''}"
+            if count == 1:
+                embed = utls.success_embed(title=codes[0], description='This code can be redeemed for a VIP subscription.')
+                embed.add_field(name='Duration:', value=duration_str, inline=False)
+                embed.add_field(name='Expiry date:', value=utls.datetime_to_string(expiry_date), inline=False)
+                await ctx.respond(embed=embed)
+                return
+
+            # Write the codes to a StringIO buffer
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(["Code", "Duration", "Expiry Date"])
+            writer.writerows([code, duration_str, utls.datetime_to_string(expiry_date)] for code in codes)
+            buffer.seek(0)
+
+            # Create a discord.File object to send
+            file = discord.File(fp=buffer, filename="codes.csv")
+
+            embed = utls.success_embed(title=f'{count} codes generated', description='These codes can be redeemed for a VIP subscription, they are in the file.')
+            embed.add_field(name='Duration:', value=duration_str, inline=False)
             embed.add_field(name='Expiry date:', value=utls.datetime_to_string(expiry_date), inline=False)
-            await ctx.respond(embed=embed)
+            await ctx.respond(embed=embed, file=file)
 
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
@@ -232,34 +347,21 @@ class VIPCommand(commands.Cog):
             # check if user exists in the database and add them if not
             user, isNew = await utls.get_or_add_member(ctx.author)
 
-            # check if the code exists in the database and whether it has been claimed or not
-            unique_code, err_msg = await utls.validate_code(code)
-            if err_msg:
-                await ctx.respond(embed=utls.warning_embed(err_msg))
+            # claim the code and extend or create the subscription in one transaction, only one member can win a code
+            subscription, duration, original_end_date = await ops.redeem_code(code, user)
+            if not subscription:
+                # find out why the code could not be claimed
+                unique_code, err_msg = await utls.validate_code(code)
+                await ctx.respond(embed=utls.warning_embed(err_msg or 'This code has been claimed.'))
                 return
+            extension = original_end_date is not None
 
-            # get the duration of the code
-            duration = await ops.get_sub_duration_by_code(unique_code)
-
-            # mark the code as redeemed
-            await ops.redeem_code(unique_code, user) # TODO: FIX THIS
-
-            # check if the user already has a subscription and if so, if end_date is not expired yet and still active, then update the end_date, otherwise insert a new subscription
-            subscription = await ops.get_active_subscription(user)
-            extension = False
-            if subscription and subscription.is_now_active():
-                extension = True
-                subscription, original_end_date = await ops.extend_subscription(subscription, duration)
-            else:
-                subscription = await ops.create_subscription(user, duration)
-            
             # Change user role to VIP if not already
             if subscription.is_now_active():
                 # Keep the member's VIP role from the free trila
-                if ctx.author.id in self.perm_vips:
-                    self.perm_vips[ctx.author.id] = True
-                    
-                await ctx.author.add_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
+                await self.keep_free_trials([ctx.author.id])
+
+                await self.roles.add_role(ctx.author, discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
 
             if extension:
                 embed = utls.success_embed(title='Extension', description=f'Your subscription has been extended:')
@@ -292,60 +394,62 @@ class VIPCommand(commands.Cog):
                 await ctx.respond(embed=utls.warning_embed('You are not allowed to use this command.'))
                 return
             
-            # check if admin exists in the database and add them if not
-            admin, isNew = await utls.get_or_add_member(ctx.author)
-
-            # check if user exists in the database and add them if not
-            user, isNew = await utls.get_or_add_member(member)
-            
             # TODO 1: make granting and extending subscription work by date (e.g 1 month from start date 2023-05-10 => end date: 2023-06-10, regardless of month duration)
 
             # convert subscription start date to datetime
             start_date = start_date.split()[0].strip()
             start_date = datetime.strptime(start_date, "%Y-%m-%d") # e.g. start_date = 2023-05-10
 
-            # check if the duration is valid
-            duration, err_msg = await utls.validate_duration(duration)
+            # the subscription change and its Grant row share one unit of work: one connection, one commit, all or nothing
+            async with ops.unit_of_work() as session:
+                # check if admin exists in the database and add them if not
+                admin, isNew = await utls.get_or_add_member(ctx.author, session)
+
+                # check if user exists in the database and add them if not
+                user, isNew = await utls.get_or_add_member(member, session)
+
+                # check if the duration is valid
+                duration, err_msg = await utls.validate_duration(duration, session)
+                if not err_msg:
+                    # check if the user already has a subscription and if so, if end_date is not expired yet and still active, then update the end_date, otherwise insert a new subscription
+                    original_end_date = None
+                    subscription = await ops.get_active_subscription(user, session)
+                    extension = False
+                    if subscription and subscription.is_now_active() and subscription.end_date >= start_date:
+                        extension = True
+                        subscription, original_end_date = await ops.set_extend_subscription(subscription, start_date, duration, session)
+                    else:
+                        subscription = await ops.set_create_subscription(user, start_date, duration, session)
+
+                    if original_end_date is None:
+                        original_end_date = subscription.end_date
+
+                    # add the grant to the database
+                    grant_date = datetime.now()
+                    action_type = 'extend' if extension else 'grant'
+                    grant = mdls.Grant(grant_date, original_end_date, subscription.end_date, duration, subscription, admin, user, action_type=action_type)
+                    await ops.add_grant(grant, session)
+
+                    # Keep the member's VIP role from the free trila
+                    if subscription.is_now_active():
+                        await self.keep_free_trials([member.id], session)
+
             if err_msg:
                 await ctx.respond(embed=utls.warning_embed(err_msg))
                 return
 
-            # check if the user already has a subscription and if so, if end_date is not expired yet and still active, then update the end_date, otherwise insert a new subscription
-            original_end_date = None
-            subscription = await ops.get_active_subscription(user)
-            extension = False
-            if subscription and subscription.is_now_active() and subscription.end_date >= start_date:
-                extension = True
-                subscription, original_end_date = await ops.set_extend_subscription(subscription, start_date, duration)
-            else:
-                subscription = await ops.set_create_subscription(user, start_date, duration)
-
             # Change user role to VIP if not already
             vipStatus = 0
             if subscription.is_now_active():
-                # Keep the member's VIP role from the free trila
-                if member.id in self.perm_vips:
-                    self.perm_vips[member.id] = True
-
                 if not discord.utils.get(member.roles, name='🌟 VIP'):
                     vipStatus = 1
-                    await member.add_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
+                    await self.roles.add_role(member, discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
                 else:
                     vipStatus = 2
             else:
                 if discord.utils.get(member.roles, name='🌟 VIP'):
                     vipStatus = -1
-                    await member.remove_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
-
-
-            if original_end_date is None:
-                original_end_date = subscription.end_date
-
-            # add the grant to the database
-            grant_date = datetime.now()
-            action_type = 'extend' if extension else 'grant'
-            grant = mdls.Grant(grant_date, original_end_date, subscription.end_date, duration, subscription, admin, user, action_type=action_type)
-            await ops.add_grant(grant)
+                    await self.roles.remove_role(member, discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
 
             unexpected_error = False
 
@@ -430,59 +534,35 @@ class VIPCommand(commands.Cog):
                 await ctx.respond(embed=utls.warning_embed(err_msg))
                 return
 
-            # get all members
-            members = ctx.guild.members
+            # get all members, skipping bots and admins
             admin_members = utls.get_admins_and_owners(ctx.guild)
+            members = {member.id: member for member in ctx.guild.members if member != ctx.bot.user and not member.bot and member not in admin_members}
 
             await ctx.defer()
 
-            # grant VIP subscription to all members
-            for member in members:
-                # Skip bots and admins
-                if member == ctx.bot.user or member.bot:
-                    continue
-                if member in admin_members:
-                    continue
-                # check if user exists in the database and add them if not
-                user, isNew = await utls.get_or_add_member(member)
-                # check if the user already has a subscription and if so, if end_date is not expired yet and still active, then update the end_date, otherwise insert a new subscription
-                original_end_date = None
-                subscription = await ops.get_active_subscription(user)
-                extension = False
-                if subscription and subscription.is_now_active():
-                    extension = True
-                    subscription, original_end_date = await ops.extend_subscription(subscription, duration)
-                else:
-                    subscription = await ops.create_subscription(user, duration)
-
-                # Change user role to VIP if not already
-                vipStatus = 0
-                if subscription.is_now_active():
-                    # Keep the member's VIP role from the free trila
-                    if member.id in self.perm_vips:
-                        self.perm_vips[member.id] = True
+            # extend or create every member's subscription (and its grant record) in one transaction
+            outcomes = await ops.grant_subscriptions([(member.id, member.name + "#" + member.discriminator) for member in members.values()], duration, admin)
 
-                    if not discord.utils.get(member.roles, name='🌟 VIP'):
-                        vipStatus = 1
-                        await member.add_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
-                    else:
-                        vipStatus = 2
-                else:
-                    if discord.utils.get(member.roles, name='🌟 VIP'):
-                        vipStatus = -1
-                        await member.remove_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
-
-                if original_end_date is None:
-                    original_end_date = subscription.end_date
-
-                # add the grant to the database
-                grant_date = datetime.now()
-                action_type = 'extend' if extension else 'grant'
-                grant = mdls.Grant(grant_date, original_end_date, subscription.end_date, duration, subscription, admin, user, action_type=action_type)
-                await ops.add_grant(grant)
+            # Change members' role to VIP if not already, every granted subscription is active from now on
+            vip_role = discord.utils.get(ctx.guild.roles, name='🌟 VIP')
+            extended = 0
+            role_changes = 0
+            # Keep the members' VIP role from the free trila
+            await self.keep_free_trials([discord_uid for discord_uid, action_type, original_end_date, new_end_date in outcomes])
+            for discord_uid, action_type, original_end_date, new_end_date in outcomes:
+                member = members[discord_uid]
+                if action_type == 'extend':
+                    extended += 1
+                if vip_role not in member.roles:
+                    # queued, the dispatcher works through the rate limits in the background
+                    self.roles.add_role(member, vip_role)
+                    role_changes += 1
             
             embed = utls.success_embed(title='Grant All', description=f'All members have been granted a new VIP subscription or extended their existing one:')
             embed.add_field(name='For (duration):', value=f"{duration.duration} {duration.unit}{'s' if duration.duration > 1 else ''}", inline=False)
+            embed.add_field(name='Granted:', value=f'{len(outcomes) - extended} members', inline=False)
+            embed.add_field(name='Extended:', value=f'{extended} members', inline=False)
+            embed.add_field(name='Role changes queued:', value=f'{role_changes} (progress in /info)', inline=False)
 
             await ctx.respond(embed=embed)
 
@@ -505,39 +585,41 @@ class VIPCommand(commands.Cog):
                 await ctx.respond(embed=utls.warning_embed('You are not allowed to use this command.'))
                 return
             
-            # check if admin exists in the database and add them if not
-            admin, isNew = await utls.get_or_add_member(ctx.author)
+            # the subscription change and its Revoke row share one unit of work: one connection, one commit, all or nothing
+            async with ops.unit_of_work() as session:
+                # check if admin exists in the database and add them if not
+                admin, isNew = await utls.get_or_add_member(ctx.author, session)
 
-            # check if user exists in the database and add them if not
-            user, isNew = await utls.get_or_add_member(member)
+                # check if user exists in the database and add them if not
+                user, isNew = await utls.get_or_add_member(member, session)
+
+                # check if the user already has a subscription
+                subscription = await ops.get_active_subscription(user, session)
+
+                err_msg = None
+                if not subscription:
+                    err_msg = f'Member **{member.name}** does not have an active subscription.'
+                elif duration:
+                    # check if the duration is valid
+                    duration, err_msg = await utls.validate_duration(duration, session)
+                    if not err_msg:
+                        # reduce the user's active subscription by reducing the end_date by the duration
+                        subscription, original_end_date = await ops.reduce_subscription(subscription, duration, session)
+                else:
+                    # remove the user's active subscription by updating the end_date to now
+                    subscription, original_end_date = await ops.revoke_subscription(subscription, session)
+                    duration = None
 
-            # check if the user already has a subscription
-            subscription = await ops.get_active_subscription(user)
+                if not err_msg:
+                    # add the revoke to the database
+                    revoke_date = datetime.now()
+                    action_type = 'reduce' if duration else 'revoke'
+                    revoke = mdls.Revoke(revoke_date, original_end_date, subscription.end_date, subscription, admin, user, duration=duration, action_type=action_type)
+                    await ops.add_revoke(revoke, session)
 
-            if not subscription:
-                await ctx.respond(embed=utls.warning_embed(f'Member **{member.name}** does not have an active subscription.'))
+            if err_msg:
+                await ctx.respond(embed=utls.warning_embed(err_msg))
                 return
-
-            if duration:
-                # check if the duration is valid
-                duration, err_msg = await utls.validate_duration(duration)
-                if err_msg:
-                    await ctx.respond(embed=utls.warning_embed(err_msg))
-                    return
-                
-                # reduce the user's active subscription by reducing the end_date by the duration
-                subscription, original_end_date = await ops.reduce_subscription(subscription, duration)
-            else:
-                # remove the user's active subscription by updating the end_date to now
-                subscription, original_end_date = await ops.revoke_subscription(subscription)
-                duration = None
-            
-
-            # add the revoke to the database
-            revoke_date = datetime.now()
-            action_type = 'reduce' if duration else 'revoke'
-            revoke = mdls.Revoke(revoke_date, original_end_date, subscription.end_date, subscription, admin, user, duration=duration, action_type=action_type)
-            await ops.add_revoke(revoke)
                 
 
             quiet_mode = 'Enabled, member will not be notified' if self.silent else 'Disabled, member will be notified'
@@ -553,7 +635,7 @@ class VIPCommand(commands.Cog):
                 embed_user.add_field(name='From (old end-date):', value=utls.datetime_to_string(original_end_date), inline=False)
                 embed_user.add_field(name='To (new end-date):', value=utls.datetime_to_string(subscription.end_date), inline=False)
             else:
-                await member.remove_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
+                await self.roles.remove_role(member, discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
                 embed_admin = utls.success_embed(title='Revoke', description=f'Member **{member.mention}**\'s subscription has been revoked.')
                 embed_admin.add_field(name='Quiet Mode:', value=quiet_mode, inline=False)
                 embed_user = utls.warning_embed(title='Revoke', description=f'Your subscription has been revoked.')
@@ -601,63 +683,31 @@ class VIPCommand(commands.Cog):
                 end_date = end_date.split()[0].strip()
                 end_date = datetime.strptime(end_date, "%Y-%m-%d") # e.g. start_date = 2023-05-10
 
-            # get all members
-            members = ctx.guild.members
+            # get all members, skipping bots and admins
             admin_members = utls.get_admins_and_owners(ctx.guild)
+            members = {member.id: member for member in ctx.guild.members if member != ctx.bot.user and not member.bot and member not in admin_members}
 
             await ctx.defer()
 
-            records_updated = 0
-            # revoke or reduce VIP subscription to all members or that match the end_date
-            for member in members:
-                # Skip bots and admins
-                if member == ctx.bot.user or member.bot:
-                    continue
-                if member in admin_members:
-                    continue
-                # check if user exists in the database and add them if not
-                user, isNew = await utls.get_or_add_member(member)
-                # check if the user already has a subscription and if so, if end_date is not expired yet and still active, then update the end_date, otherwise insert a new subscription
-                original_end_date = None
-                subscription = await ops.get_active_subscription(user)
-                
-                
-                if subscription:
-                    if duration:
-                        if end_date: 
-                            if end_date == subscription.end_date:
-                                # reduce the user's active subscription by reducing the end_date by the duration
-                                subscription, original_end_date = await ops.reduce_subscription(subscription, duration)
-                                records_updated += 1
-                        else:
-                            # reduce the user's active subscription by reducing the end_date by the duration
-                            subscription, original_end_date = await ops.reduce_subscription(subscription, duration)
-                            records_updated += 1
-                    else:
-                        if end_date:
-                            if end_date == subscription.end_date:
-                                # remove the user's active subscription by updating the end_date to now
-                                subscription, original_end_date = await ops.revoke_subscription(subscription)
-                                records_updated += 1
-                        # remove the user's active subscription by updating the end_date to now
-                        subscription, original_end_date = await ops.revoke_subscription(subscription)
-                        records_updated += 1
-
-                
-                    if subscription.is_expired() and discord.utils.get(member.roles, name='🌟 VIP') and self.role_change_mode:
-                        await member.remove_roles(discord.utils.get(ctx.guild.roles, name='🌟 VIP'))
+            # revoke or reduce the VIP subscription of all members, or only those that match the end_date, in one transaction
+            outcomes = await ops.revoke_subscriptions(members.keys(), admin, duration=duration or None, end_date=end_date or None)
+            records_updated = len(outcomes)
 
-                    # # add the revoke to the database
-                    # revoke_date = datetime.now()
-                    # action_type = 'reduce' if duration else 'revoke'
-                    # revoke = mdls.Revoke(revoke_date, original_end_date, subscription.end_date, subscription, admin, user, duration=duration, action_type=action_type)
-                    # await ops.add_revoke(revoke)
+            # only the affected members can need a role change
+            vip_role = discord.utils.get(ctx.guild.roles, name='🌟 VIP')
+            role_changes = 0
+            for discord_uid, original_end_date, new_end_date in outcomes:
+                member = members[discord_uid]
+                if new_end_date <= datetime.now() and vip_role in member.roles and self.role_change_mode:
+                    self.roles.remove_role(member, vip_role)
+                    role_changes += 1
 
             embed = utls.success_embed(title='Revoke All', description=f'{records_updated} members have been revoked or reduced their VIP subscription.')
             if duration:
                 embed.add_field(name='By (duration):', value=f"{duration.duration} {duration.unit}{'s' if duration.duration > 1 else ''}", inline=False)
             if end_date:
                 embed.add_field(name='With end_date:', value=utls.datetime_to_string(end_date), inline=False)
+            embed.add_field(name='Role changes queued:', value=f'{role_changes} (progress in /info)', inline=False)
 
             await ctx.respond(embed=embed)
 
@@ -690,7 +740,7 @@ class VIPCommand(commands.Cog):
             if subscription and not subscription.is_expired():
                 # check if the user has the VIP role and if not, add it
                 if not discord.utils.get(ctx.author.roles, name='🌟 VIP') and self.role_change_mode:
-                    await ctx.author.add_roles(vip_role)
+                    await self.roles.add_role(ctx.author, vip_role)
                 remaining_days = (subscription.end_date - datetime.now()).days
                 embed = utls.info_embed(title='Status', description=f'Your VIP subscription is active:')
                 embed.add_field(name='Until (end-date):', value=utls.datetime_to_string(subscription.end_date), inline=False)
@@ -698,7 +748,7 @@ class VIPCommand(commands.Cog):
             else:
                 # check if the user has the VIP role and if so, remove it
                 if discord.utils.get(ctx.author.roles, name='🌟 VIP') and self.role_change_mode:
-                    await ctx.author.remove_roles(vip_role)
+                    await self.roles.remove_role(ctx.author, vip_role)
                 embed = utls.info_embed(title='Status', description=f'You do not have an active VIP subscription.')
 
             await ctx.respond(embed=embed)
@@ -734,7 +784,7 @@ class VIPCommand(commands.Cog):
             if subscription and subscription.is_now_active():
                 # check if the user has the VIP role and if not, add it
                 if not discord.utils.get(member.roles, name='🌟 VIP') and self.role_change_mode:
-                    await member.add_roles(vip_role)
+                    await self.roles.add_role(member, vip_role)
                 remaining_days = (subscription.end_date - datetime.now()).days
                 embed = utls.info_embed(title='Status', description=f'{member.mention}\'s VIP subscription is active:')
                 embed.add_field(name='Until (end-date):', value=utls.datetime_to_string(subscription.end_date), inline=False)
@@ -742,7 +792,7 @@ class VIPCommand(commands.Cog):
             else:
                 # check if the user has the VIP role and if so, remove it
                 if discord.utils.get(member.roles, name='🌟 VIP') and self.role_change_mode:
-                    await member.remove_roles(vip_role)
+                    await self.roles.remove_role(member, vip_role)
                 embed = utls.info_embed(title='Status', description=f'{member.mention} does not have an active VIP subscription.')
 
             await ctx.respond(embed=embed)
@@ -788,8 +838,8 @@ class VIPCommand(commands.Cog):
 
     @discord.slash_command(name="keep")
     async def keep(self, ctx, member: discord.Member):
-        # Keep the member's VIP role
-        self.perm_vips[member.id] = True
+        # Keep the member's VIP role once the free trial ends
+        await self.keep_free_trials([member.id])
 
         # Inform the user that the member will keep the '🌟 VIP' role
         await ctx.respond(f"{member.mention} will keep the VIP role. **Use Grant or setsub commands if you didn't!**")
@@ -869,7 +919,7 @@ class VIPCommand(commands.Cog):
 
             self.sub_check_mode = not self.sub_check_mode
             
-            description = f'Automatic Subscription check task has been {"enabled" if self.sub_check_mode else "disabled"} by {ctx.author.mention}. The task will run every 3 hours.'
+            description = f'Automatic Subscription check task has been {"enabled" if self.sub_check_mode else "disabled"} by {ctx.author.mention}. Subscriptions will be handled the moment they start or expire and reconciled every {RECONCILE_INTERVAL_HOURS:g} hours, use /fcheck to catch up right away.'
             embed = utls.success_embed(title='Automatic Subscription Checking', description=description)
 
             await ctx.respond(embed=embed)
@@ -930,6 +980,10 @@ class VIPCommand(commands.Cog):
             embed.add_field(name='Automatic Subscription Checking:', value='Enabled' if self.sub_check_mode else 'Disabled', inline=False)
             embed.add_field(name='Automatic Role Changing:', value='Enabled' if self.role_change_mode else 'Disabled', inline=False)
             embed.add_field(name='Quiet Mode:', value='Enabled' if self.silent else 'Disabled', inline=False)
+            embed.add_field(name='Role Changes:', value=' / '.join(f'{count} {state}' for state, count in self.roles.progress().items()), inline=False)
+            embed.add_field(name='Pending Free Trials:', value=len(self.trials), inline=False)
+            embed.add_field(name='Admin Digest:', value=f'{len(self.digest)} queued / {self.digest.sent} sent / {self.digest.saved} messages saved', inline=False)
+            embed.add_field(name='User Cache:', value=f'{len(ops.user_cache)} cached / {ops.user_cache.hits} hits / {ops.user_cache.misses} misses', inline=False)
 
             await ctx.respond(embed=embed)
 
@@ -955,34 +1009,20 @@ class VIPCommand(commands.Cog):
             # check if admin exists in the database and add them if not
             admin, isNew = await utls.get_or_add_member(ctx.author)
 
-            users = await ops.get_users()
-            
-            csv_data = []
-            for user in users:
-                subscription = await ops.get_active_subscription(user)
-                status = '🌟 VIP' if subscription and subscription.is_now_active() else 'Free'
-                row = [user.id, user.username, status, user.discord_uid]
-                csv_data.append(row)
-
-            if len(csv_data) == 0:
-                await ctx.respond(embed=utls.info_embed(title='Users', description='No users found.'))
-                return
+            await ctx.defer()
 
+            # one query streamed in batches, the CSV is encoded off the event loop
             headers = ["ID", "Username", "Status", "Discord ID"]
-            csv_data.insert(0, headers)
+            format_row = lambda row: [row[0], row[1], '🌟 VIP' if row[3] else 'Free', row[2]]
+            export, elapsed = await export_csv('users', headers, ops.stream_user_statuses(), ctx.guild.filesize_limit, format_row)
 
-            # Write the data to a StringIO buffer
-            buffer = io.StringIO()
-            writer = csv.writer(buffer)
-            writer.writerows(csv_data)
-            buffer.seek(0)
-
-            # Create a discord.File object to send
-            file = discord.File(fp=buffer, filename="users.csv")
+            if export.rows == 0:
+                export.discard()
+                await ctx.respond(embed=utls.info_embed(title='Users', description='No users found.'))
+                return
 
             embed = utls.info_embed(title='All Users info are in the file')
-
-            message = await ctx.respond(embed=embed, file=file)
+            await self.respond_with_export(ctx, embed, export, elapsed)
 
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
@@ -1006,38 +1046,21 @@ class VIPCommand(commands.Cog):
             # check if admin exists in the database and add them if not
             admin, isNew = await utls.get_or_add_member(ctx.author)
 
-            # get all the members in the database
-            subscriptions = await ops.get_active_subscriptions()
+            await ctx.defer()
 
-            csv_data = []
-            for subscription in subscriptions:
-                status = 'Active' if subscription.is_now_active() else 'pending' if subscription.is_future() else 'Expired' if subscription.is_expired() else 'Unknown'
-                user = await ops.get_user_by_subscription(subscription)
-                # days only
-                start_date = subscription.start_date.strftime("%Y-%m-%d")
-                end_date = subscription.end_date.strftime("%Y-%m-%d")
-                row = [user.discord_uid, start_date, end_date, status]
-                csv_data.append(row)
+            # the subscriptions and their users come from one JOIN query, dates are exported as days only
+            now = datetime.now()
+            headers = ["User's discord ID", "Start Date", "End Date", "Status"]
+            format_row = lambda row: [row[0], row[1].strftime("%Y-%m-%d"), row[2].strftime("%Y-%m-%d"), utls.subscription_status(row[1], row[2], now)]
+            export, elapsed = await export_csv('active_subscriptions', headers, ops.stream_active_subscriptions(), ctx.guild.filesize_limit, format_row)
 
-            if len(csv_data) == 0:
+            if export.rows == 0:
+                export.discard()
                 await ctx.respond(embed=utls.warning_embed('There are no active subscriptions.'))
                 return
 
-            headers = ["User's discord ID", "Start Date", "End Date", "Status"]
-            csv_data.insert(0, headers)
-
-            # Write the data to a StringIO buffer
-            buffer = io.StringIO()
-            writer = csv.writer(buffer)
-            writer.writerows(csv_data)
-            buffer.seek(0)
-
-            # Create a discord.File object to send
-            file = discord.File(fp=buffer, filename="active_subscriptions.csv")
-
             embed = utls.info_embed(title='All Active Subscriptions info are in the file')
-
-            message = await ctx.respond(embed=embed, file=file)
+            await self.respond_with_export(ctx, embed, export, elapsed)
 
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
@@ -1058,29 +1081,25 @@ class VIPCommand(commands.Cog):
                 await ctx.respond(embed=utls.warning_embed('You are not allowed to use this command.'))
                 return
             
-            # check if admin exists in the database and add them if not
             guild = self.bot.guilds[0]
+            members = [member for member in guild.members if not member.bot]
 
-            csv_data = []
-            for member in guild.members:
-                if member.bot:
-                    continue
-
-                user, isNew = await utls.get_or_add_member(member)
-            
-                active_subscription = await ops.get_active_subscription(user)
+            # every member is registered with one upsert and the subscriptions come from two queries, not two per member
+            await ops.register_users([(member.id, member.name + "#" + member.discriminator) for member in members])
+            active_ids = (await ops.get_active_subscription_end_dates()).keys()
+            subscribed_ids = await ops.get_subscribed_discord_uids()
 
-                subscriptions = await ops.get_subscriptions(user)
-
-                if active_subscription:
+            csv_data = []
+            for member in members:
+                if member.id in active_ids:
                     continue
                 if isvip and not discord.utils.get(member.roles, name='🌟 VIP'):
                     continue
                 if not isvip and discord.utils.get(member.roles, name='🌟 VIP'):
                     continue
-                if hassubs and not subscriptions:
+                if hassubs and member.id not in subscribed_ids:
                     continue
-                if not hassubs and subscriptions:
+                if not hassubs and member.id in subscribed_ids:
                     continue
 
                 row = [member.id, member.name, member.discriminator]
@@ -1132,35 +1151,18 @@ class VIPCommand(commands.Cog):
             # check if admin exists in the database and add them if not
             user, isNew = await utls.get_or_add_member(member)
 
-            subscriptions = await ops.get_subscriptions(user)
-            
-            csv_data = []
-            for subscription in subscriptions:
-                status = 'Active' if subscription.is_now_active() else 'pending' if subscription.is_future() else 'Expired' if subscription.is_expired() else 'Unknown'
-                start_date = subscription.start_date.strftime("%Y-%m-%d")
-                end_date = subscription.end_date.strftime("%Y-%m-%d")
-                row = [subscription.id, start_date, end_date, status]
-                csv_data.append(row)
+            now = datetime.now()
+            headers = ["ID", "Start Date", "End Date", "Status"]
+            format_row = lambda row: [row[0], row[1].strftime("%Y-%m-%d"), row[2].strftime("%Y-%m-%d"), utls.subscription_status(row[1], row[2], now)]
+            export, elapsed = await export_csv(f'{member.name}_subscriptions', headers, ops.stream_user_subscriptions(user), ctx.guild.filesize_limit, format_row)
 
-            if len(csv_data) == 0:
+            if export.rows == 0:
+                export.discard()
                 await ctx.respond(embed=utls.warning_embed('This user has no subscriptions.'))
                 return
-            
-            headers = ["ID", "Start Date", "End Date", "Status"]
-            csv_data.insert(0, headers)
-
-            # Write the data to a StringIO buffer
-            buffer = io.StringIO()
-            writer = csv.writer(buffer)
-            writer.writerows(csv_data)
-            buffer.seek(0)
-
-            # Create a discord.File object to send
-            file = discord.File(fp=buffer, filename=f"{member.name}_subscriptions.csv")
 
             embed = utls.info_embed(title=f"All {user.username} Subscriptions are in the file")
-
-            await ctx.respond(embed=embed, file=file)
+            await self.respond_with_export(ctx, embed, export, elapsed)
 
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
@@ -1184,14 +1186,15 @@ class VIPCommand(commands.Cog):
             # check if admin exists in the database and add them if not
             admin, isNew = await utls.get_or_add_member(ctx.author)
 
-            # get all the members of the server
-            members = ctx.guild.members
+            await ctx.defer()
 
-            # add all the members to the database
-            for member in members:
-                user, isNew = await utls.get_or_add_member(member)
+            # add all the members of the server to the database (and refresh changed usernames) in one transaction
+            members = [(member.id, member.name + "#" + member.discriminator) for member in ctx.guild.members]
+            inserted, updated = await ops.register_users(members)
 
             embed = utls.success_embed(title='All members have been added to the database successfully.')
+            embed.add_field(name='New users:', value=f'{inserted} users', inline=False)
+            embed.add_field(name='Updated usernames:', value=f'{updated} users', inline=False)
 
             await ctx.respond(embed=embed)
 
@@ -1276,12 +1279,13 @@ class VIPCommand(commands.Cog):
             # get all the members with the vip role
             members = vip_role.members
 
-            # remove the vip role from all the members
-            for member in members:
-                if self.role_change_mode:
-                    await member.remove_roles(vip_role)
+            # queue the removal of the vip role from all the members
+            if self.role_change_mode:
+                for member in members:
+                    self.roles.remove_role(member, vip_role)
 
             embed = utls.success_embed('All members with the VIP role have been removed from the role.')
+            embed.add_field(name='Role changes queued:', value=f'{len(members) if self.role_change_mode else 0} (progress in /info)', inline=False)
 
             await ctx.respond(embed=embed)
 
@@ -1316,7 +1320,7 @@ class VIPCommand(commands.Cog):
             # remove the vip role from all the members and their active subscriptions
             for member in members:
                 if self.role_change_mode:
-                    await member.remove_roles(vip_role)
+                    self.roles.remove_role(member, vip_role)
                 user, isNew = await utls.get_or_add_member(member)
                 subscription = await ops.get_active_subscription(user)
                 if subscription is not None:
@@ -1415,6 +1419,7 @@ class VIPCommand(commands.Cog):
 
 
     @commands.Cog.listener()
+    @metrics.track_invocation
     async def on_member_join(self, member: discord.Member):
         # get the vip role
         vip_role = discord.utils.get(member.guild.roles, name='🌟 VIP')
@@ -1428,10 +1433,16 @@ class VIPCommand(commands.Cog):
         if not isNew and user.free_trial_used:
             return
         
-        if not user.free_trial_used:
-            await ops.toggle_free_trial_user(user)
-        
-        await member.add_roles(vip_role)
+        # the expiry is persisted (with the trial marked as used) and scheduled before the role is given,
+        # so a restart or a failed message can not leave the member with the role for good
+        expires_at = datetime.now() + FREE_TRIAL_DURATION
+        async with ops.unit_of_work() as session:
+            if not user.free_trial_used:
+                await ops.toggle_free_trial_user(user, session)
+            await ops.start_free_trial(member.id, expires_at, session)
+        self.trials.schedule(member.id, expires_at, self.on_free_trial_expired, member.id)
+
+        await self.roles.add_role(member, vip_role)
         # send him a private message informing him that he has been given the vip role temporarily as a free-trial, and if he paid he will get reinstaited (in an embed)
         owner_role = discord.utils.get(member.guild.roles, name='👑 Owner')
         owner_members = owner_role.members
@@ -1441,27 +1452,42 @@ class VIPCommand(commands.Cog):
         guild_name = member.guild.name
         # embed = utls.info_embed(title=f'{guild_name} VIP role free trial', description=f'You have been given the VIP role temporarily. You will keep it for 20 minutes, after which it will be removed. However, if you already paid for the VIP role, you will get reinstated automatically.')
         member_embed = utls.info_embed(title=f'تجربة مجانية لدور  MKL-Signals - VIP', description=f'لقد تم منحك دور **VIP** مؤقتًا. ستحتفظ بها لمدة 20 دقائق ، وبعد ذلك ستتم إزالتها. ومع ذلك ، إذا كنت قد دفعت بالفعل مقابل دور **VIP** ، فستتم إعادتك تلقائيًا.')
-        try:
-            await member.send(embed=member_embed)
-        except discord.Forbidden:
-            logging.error(f"Unable to send message to {member}")
+        await utls.send_dm(member, embed=member_embed)
 
-        # loop through owners and admins and inform them
+        # owners and admins are informed in their next digest
         member_name = member.name + "#" + member.discriminator
         admin_embed = utls.info_embed(title=f'{guild_name} VIP role free trial for {member_name}', description=f'{member.mention} has joined the server and has been given the VIP role temporarily. He will keep it for 20 minutes, after which it will be removed.')
-        admin_embed.add_field(name='Note', value='Buttons are just for testing, they do nothing now', inline=False)
-        for owner in owner_members:
-            await owner.send(embed=admin_embed, view=NewMemberButtonsView())
-        for admin in admin_members:
-            await admin.send(embed=admin_embed, view=NewMemberButtonsView())
-        
-        # Add the member's user ID to the perm_vips dictionary
-        self.perm_vips[member.id] = False
+        self.digest.add(owner_members + admin_members, admin_embed)
+
+
+    async def keep_free_trials(self, member_ids: list[int], session=None) -> int:
+        # the pending timers answer whether a member is in a free trial, only those members are written to the database
+        member_ids = [member_id for member_id in member_ids if member_id in self.trials]
+        if member_ids:
+            await ops.keep_free_trials(member_ids, session)
+        return len(member_ids)
+
+
+    @metrics.track_invocation
+    async def on_free_trial_expired(self, discord_uid: int):
+        kept = await ops.end_free_trial(discord_uid)
+        guild = self.bot.guilds[0]
+        member = guild.get_member(discord_uid)
+        # the member left the server, or the trial was already handled
+        if kept is None or member is None:
+            return
+
+        vip_role = discord.utils.get(guild.roles, name='🌟 VIP')
+        owner_role = discord.utils.get(guild.roles, name='👑 Owner')
+        owner_members = owner_role.members
+        admin_role = discord.utils.get(guild.roles, name='🛡️ Admin')
+        admin_members = admin_role.members
+        guild_name = guild.name
+        member_name = member.name + "#" + member.discriminator
 
-        await asyncio.sleep(1200)
         # check if user is still in the server and if he is, remove the vip role
-        if self.perm_vips[member.id] == False:
-            await member.remove_roles(vip_role)
+        if not kept:
+            self.roles.remove_role(member, vip_role)
 
             # embed = utls.info_embed(title=f'{guild_name} VIP role free trial expired', description=f'Your VIP role free trial has expired. If you want to keep the VIP role, please contact one of the owners of the server.')
             member_embed = utls.info_embed(title=f'انتهت الفترة التجريبية المجانية لدور  MKL-Signals - VIP ', description=f'انتهت صلاحية الإصدار التجريبي المجاني لدور VIP الخاص بك. إذا كنت ترغب في الاحتفاظ بدور **VIP**، يرجى الاتصال بأحد مالكي خادم **MKL-Signals**.')
@@ -1469,36 +1495,17 @@ class VIPCommand(commands.Cog):
                 owner_name = owner.name + "#" + owner.discriminator
                 member_embed.add_field(name=f'{owner_name}', value=f'{owner.mention}', inline=False)
             
-            try:
-                await member.send(embed=member_embed)
-            except discord.Forbidden:
-                logging.error(f"Unable to send message to {member}")
+            await utls.send_dm(member, embed=member_embed)
 
             admin_embed = utls.info_embed(title=f'{guild_name} VIP role free trial expired for {member_name}', description=f'{member.mention} has had his VIP role removed after the free trial expired. If he wants to keep the VIP role, he will have to contact one of the owners of the server.')
-            for owner in owner_members:
-                owner_name = owner.name + "#" + owner.discriminator
-                admin_embed.add_field(name=f'{owner_name}', value=f'{owner.mention}', inline=False)
-            
-            for owner in owner_members:
-                await owner.send(embed=admin_embed)
-            for admin in admin_members:
-                await admin.send(embed=admin_embed)
+            self.digest.add(owner_members + admin_members, admin_embed)
         else:
             # embed = utls.info_embed(title=f'{guild_name} VIP role free trial expired', description=f'Your VIP role free trial has expired, but you have paid for the VIP role, so you will keep it.')
             member_embed = utls.info_embed(title=f'انتهت الفترة التجريبية المجانية لدور  MKL-Signals - VIP ', description=f'انتهت صلاحية الإصدار التجريبي المجاني لدور **VIP** الخاص بك ، لكنك دفعت مقابل دور **VIP** ، لذلك ستحتفظ به.')
-            try:
-                await member.send(embed=member_embed)
-            except discord.Forbidden:
-                logging.error(f"Unable to send message to {member}")
+            await utls.send_dm(member, embed=member_embed)
 
             admin_embed = utls.info_embed(title=f'{guild_name} VIP role free trial expired for {member_name}', description=f'{member.mention} VIP role free trial expired, but he was given a new active subscription or `keep` was used on him, so he will keep the VIP role.')
-            for owner in owner_members:
-                await owner.send(embed=admin_embed)
-            for admin in admin_members:
-                await admin.send(embed=admin_embed)
-
-        # Remove the member from the dictionary if they are in it
-        del self.perm_vips[member.id]
+            self.digest.add(owner_members + admin_members, admin_embed)
 
 
     @commands.Cog.listener()
@@ -1532,66 +1539,172 @@ class VIPCommand(commands.Cog):
         await self.send_private_error_notification("on_error", event, traceback.format_exc())
         
     async def send_private_error_notification(self, username: str = '', command: str = '', error_message: str = ''):
+        metrics.COMMAND_ERRORS.inc(command=command)
         owner_id = ADMIN_USER_ID
+        start_time = time.perf_counter()
         owner = await self.bot.fetch_user(owner_id)
+        metrics.observe_discord_call('users', start_time)
         await owner.send(embed=utls.error_embed(f"An error occurred (u: {username}, c: {command}): {error_message}"))
 
 
-    async def check_subscriptions(self) -> tuple[int, int]:
+    @metrics.track_invocation
+    async def check_subscriptions(self) -> tuple[int, int, dict[str, float]]:
         self.sub_check_in_progress = True
         logging.info('Checking subscriptions...')
-        guild = self.bot.guilds[0]
-        vip_role = discord.utils.get(guild.roles, name='🌟 VIP')
-        admin_members = utls.get_admins_and_owners(guild)
-        records_updated = 0
-        for member in guild.members:
-            # Skip bots and admins
-            if member.bot:
-                continue
-            if member in admin_members:
-                continue
-            user, isNew = await utls.get_or_add_member(member)
-            subscription = await ops.get_active_subscription(user)
-            member_name = member.name + "#" + member.discriminator
-            if vip_role in member.roles: 
-                if subscription: 
-                    if subscription.is_expiring_soon(days=1):
-                        embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription is about to end in less than 1 day.')
-                        embed_user = utls.warning_embed(f'Your VIP subscription is about to end in less than 1 day.')
-                    else:
-                        continue
-                else:
-                    embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription has ended.')
-                    embed_user = utls.warning_embed(f'Your VIP subscription has ended.')
-                    await member.remove_roles(vip_role)
-                    records_updated += 1
-            elif subscription and subscription.is_now_active():
+        try:
+            timings = {}
+            guild = self.bot.guilds[0]
+            vip_role = discord.utils.get(guild.roles, name='🌟 VIP')
+            admin_members = utls.get_admins_and_owners(guild)
+            admin_ids = {admin.id for admin in admin_members}
+
+            # load: every active subscription in one query (discord_uid -> end_date)
+            phase_start = time.time()
+            end_dates = await ops.get_active_subscription_end_dates()
+            timings['load'] = time.time() - phase_start
+
+            # diff: only members whose VIP role disagrees with their subscription need any work
+            phase_start = time.time()
+            members = {member.id: member for member in guild.members if not member.bot and member.id not in admin_ids}
+            vip_ids = {member.id for member in vip_role.members if member.id in members}
+            subscribed_ids = members.keys() & end_dates.keys()
+            to_remove = vip_ids - subscribed_ids
+            to_add = subscribed_ids - vip_ids
+            now = datetime.now()
+            self.reminded = {member_id: end_date for member_id, end_date in self.reminded.items() if end_date > now}
+            expiring_soon = now + timedelta(days=1)
+            to_remind = {member_id for member_id in vip_ids & subscribed_ids if end_dates[member_id] < expiring_soon and self.reminded.get(member_id) != end_dates[member_id]}
+            timings['diff'] = time.time() - phase_start
+
+            # apply: role changes and notifications for the symmetric difference (plus expiry reminders)
+            phase_start = time.time()
+            role_changes = []
+            for member_id in to_remind:
+                member = members[member_id]
+                member_name = member.name + "#" + member.discriminator
+                embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription is about to end in less than 1 day.')
+                embed_user = utls.warning_embed(f'Your VIP subscription is about to end in less than 1 day.')
+                self.reminded[member_id] = end_dates[member_id]
+                await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+
+            for member_id in to_remove:
+                member = members[member_id]
+                member_name = member.name + "#" + member.discriminator
+                embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription has ended.')
+                embed_user = utls.warning_embed(f'Your VIP subscription has ended.')
+                role_changes.append(self.roles.remove_role(member, vip_role))
+                await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+
+            for member_id in to_add:
+                member = members[member_id]
+                member_name = member.name + "#" + member.discriminator
                 embed_admin = utls.success_embed(f'{member.mention}\'s ({member_name}) VIP role has been reinstated as his subscription is still active.')
                 embed_user = utls.success_embed(f'Your VIP role has been reinstated as your subscription is still active.')
-                await member.add_roles(vip_role)
-                records_updated += 1
+                role_changes.append(self.roles.add_role(member, vip_role))
+                await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+            await asyncio.gather(*role_changes)
+            timings['apply'] = time.time() - phase_start
+
+            logging.info(f'Finished checking subscriptions: {len(to_add)} reinstated, {len(to_remove)} removed, {len(to_remind)} reminded.')
+            return len(guild.members), len(to_add) + len(to_remove), timings
+        finally:
+            self.sub_check_in_progress = False
+    
+
+    def schedule_subscription(self, subscription_id: int, user_id: int, start_date: datetime, end_date: datetime) -> None:
+        # subscriptions granted with a future start date get their VIP role when they start
+        if datetime.now() < start_date < end_date:
+            self.scheduler.schedule(('start', subscription_id), start_date, self.on_subscription_started, user_id)
+        else:
+            self.scheduler.cancel(('start', subscription_id))
+        self.scheduler.schedule(('expire', subscription_id), end_date, self.on_subscription_expired, user_id)
+        remind_date = end_date - timedelta(days=1)
+        if remind_date > datetime.now():
+            self.scheduler.schedule(('remind', subscription_id), remind_date, self.on_subscription_expiring, user_id)
+        else:
+            self.scheduler.cancel(('remind', subscription_id))
+
+
+    async def get_scheduled_member(self, user_id: int) -> tuple[mdls.User, discord.Member, list]:
+        guild = self.bot.guilds[0]
+        user = await ops.get_user_by_id(user_id)
+        member = guild.get_member(user.discord_uid) if user else None
+        admin_members = utls.get_admins_and_owners(guild)
+        if member is None or member.bot or member in admin_members:
+            return user, None, admin_members
+        return user, member, admin_members
+
+
+    @metrics.track_invocation
+    async def on_subscription_started(self, user_id: int):
+        if not self.sub_check_mode:
+            return
+        user, member, admin_members = await self.get_scheduled_member(user_id)
+        vip_role = discord.utils.get(self.bot.guilds[0].roles, name='🌟 VIP')
+        if member is None or vip_role in member.roles:
+            return
+        if not await ops.get_active_subscription(user):
+            return
+        member_name = member.name + "#" + member.discriminator
+        embed_admin = utls.success_embed(f'{member.mention}\'s ({member_name}) VIP subscription has started.')
+        embed_user = utls.success_embed(f'Your VIP subscription has started.')
+        self.roles.add_role(member, vip_role)
+        await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+
+
+    @metrics.track_invocation
+    async def on_subscription_expired(self, user_id: int):
+        if not self.sub_check_mode:
+            return
+        user, member, admin_members = await self.get_scheduled_member(user_id)
+        vip_role = discord.utils.get(self.bot.guilds[0].roles, name='🌟 VIP')
+        if member is None or vip_role not in member.roles:
+            return
+        # another subscription may still be running, its own expiry is scheduled separately
+        if await ops.get_active_subscription(user):
+            return
+        member_name = member.name + "#" + member.discriminator
+        embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription has ended.')
+        embed_user = utls.warning_embed(f'Your VIP subscription has ended.')
+        self.roles.remove_role(member, vip_role)
+        await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+
+
+    @metrics.track_invocation
+    async def on_subscription_expiring(self, user_id: int):
+        if not self.sub_check_mode:
+            return
+        user, member, admin_members = await self.get_scheduled_member(user_id)
+        vip_role = discord.utils.get(self.bot.guilds[0].roles, name='🌟 VIP')
+        if member is None or vip_role not in member.roles:
+            return
+        subscription = await ops.get_active_subscription(user)
+        if not subscription or not subscription.is_expiring_soon(days=1) or self.reminded.get(member.id) == subscription.end_date:
+            return
+        self.reminded[member.id] = subscription.end_date
+        member_name = member.name + "#" + member.discriminator
+        embed_admin = utls.warning_embed(f'{member.mention}\'s ({member_name}) VIP subscription is about to end in less than 1 day.')
+        embed_user = utls.warning_embed(f'Your VIP subscription is about to end in less than 1 day.')
+        await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
+
+
+    async def respond_with_export(self, ctx, embed, export, elapsed: float):
+        embed.add_field(name='Rows:', value=export.rows, inline=False)
+        embed.add_field(name='Size:', value=f"{round(export.size / 1024, 1)} KiB{' (gzip)' if export.compressed else ''} in {len(export.parts)} file{'s' if len(export.parts) > 1 else ''}", inline=False)
+        embed.add_field(name='Generated in:', value=f'{round(elapsed, 2)} seconds', inline=False)
+        files = export.files()
+        for start in range(0, len(files), MAX_FILES_PER_MESSAGE):
+            if start == 0:
+                await ctx.respond(embed=embed, files=files[start:start + MAX_FILES_PER_MESSAGE])
             else:
-                continue
+                await ctx.respond(files=files[start:start + MAX_FILES_PER_MESSAGE])
 
-            await self.send_embed_messages(embed_admin, embed_user, member, admin_members)
-                
-        logging.info('Finished checking subscriptions.')
-        self.sub_check_in_progress = False
-        return len(guild.members), records_updated
-    
 
     async def send_embed_messages(self, embed_admin, embed_user, member, admin_members):
+        # the member is told right away, admins get it with the next digest
         if not self.silent:
-            try:
-                await member.send(embed=embed_user)
-            except discord.Forbidden:
-                print(f"Was not able to send message to {member.name}")
-
-        for admin in admin_members:
-            try:
-                await admin.send(embed=embed_admin)
-            except discord.Forbidden:
-                print(f"Was not able to send message to {admin.name}")
+            await utls.send_dm(member, embed=embed_user)
+        self.digest.add(admin_members, embed_admin)
 
 
 def setup(bot): # this is called by Pycord to setup the cog
@@ -0,0 +1,79 @@
+import asyncio
+import csv
+import io
+import logging
+from datetime import datetime
+import discord
+
+import utils as utls
+
+
+# an embed description holds at most 4096 characters, longer digests are sent as a CSV file
+MAX_EMBED_DIGEST_LENGTH = 4000
+
+
+class AdminDigest:
+    # Buffers admin notifications for window seconds, then every admin gets all of them in one message.
+    # Admins are deduplicated by id, so owners that are also admins are messaged once.
+    def __init__(self, name: str, window: float):
+        self.name = name
+        self.window = window
+        self.notifications = 0
+        self.sent = 0
+        self.saved = 0
+        self._pending = {}
+        self._task = None
+        self._flush_now = asyncio.Event()
+
+    def __len__(self) -> int:
+        return sum(len(entries) for admin, entries in self._pending.values())
+
+    def add(self, admins: list, embed: discord.Embed) -> None:
+        text = ' - '.join(part for part in (embed.title, embed.description) if part)
+        entry = (datetime.now(), text)
+        for admin in {admin.id: admin for admin in admins}.values():
+            self._pending.setdefault(admin.id, (admin, []))[1].append(entry)
+            self.notifications += 1
+        if self._task is None or self._task.done():
+            self._flush_now.clear()
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def stop(self) -> None:
+        # whatever is still buffered goes out right away. The timer is woken up rather than cancelled, so a flush
+        # already sending is never cut off halfway
+        self._flush_now.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._pending:
+            await self.flush()
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+        await self.flush()
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        for admin, entries in pending.values():
+            if await utls.send_dm(admin, **self.build_message(entries)):
+                self.sent += 1
+                self.saved += len(entries) - 1
+        if pending:
+            logging.info(f'Digest {self.name}: sent {len(pending)} digests, {self.saved} messages saved so far.')
+
+    def build_message(self, entries: list) -> dict:
+        lines = [f'`{utls.datetime_to_string(date)}` {text}' for date, text in entries]
+        title = f'{len(entries)} notification{"s" if len(entries) > 1 else ""}'
+        if sum(len(line) + 1 for line in lines) <= MAX_EMBED_DIGEST_LENGTH:
+            return {'embed': utls.info_embed(title=title, description='\n'.join(lines))}
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['date', 'notification'])
+        writer.writerows((utls.datetime_to_string(date), text) for date, text in entries)
+        output.seek(0)
+        file = discord.File(io.BytesIO(output.getvalue().encode()), filename=f'{self.name}_{datetime.now().strftime("%Y%m%d%H%M%S")}.csv')
+        return {'embed': utls.info_embed(title=title, description='The notifications are in the attached file.'), 'file': file}
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import random
+import time
+import discord
+
+import metrics
+
+
+class RoleDispatcher:
+    # Applies role changes with a bounded pool of workers. While a change waits in the queue, newer intents for the same
+    # member and role only replace its desired state, so just the final one is sent. Rate limits are py-cord's business:
+    # HTTPClient.request waits on the per route bucket and sleeps through a 429 before retrying, so a call never fails
+    # with one here (they are counted by metrics.RateLimitHandler). Server errors py-cord gave up on are retried with backoff.
+    def __init__(self, name: str, workers: int = 4, max_retries: int = 5):
+        self.name = name
+        self.workers = workers
+        self.max_retries = max_retries
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self._pending = {}
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add_role(self, member: discord.Member, role: discord.Role) -> asyncio.Future:
+        return self.set_role(member, role, True)
+
+    def remove_role(self, member: discord.Member, role: discord.Role) -> asyncio.Future:
+        return self.set_role(member, role, False)
+
+    def set_role(self, member: discord.Member, role: discord.Role, present: bool) -> asyncio.Future:
+        # the future resolves to True once the change went through, False when it failed for good, and is cancelled by stop()
+        key = (member.id, role.id)
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry[0], entry[2] = member, present
+            self.coalesced += 1
+            return entry[3]
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = [member, role, present, future]
+        self._queue.put_nowait(key)
+        self.start()
+        return future
+
+    def progress(self) -> dict[str, int]:
+        return {'queued': len(self._pending), 'sent': self.sent, 'coalesced': self.coalesced, 'retried': self.retried, 'failed': self.failed}
+
+    def start(self) -> None:
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def join(self) -> None:
+        # waits until every queued change was applied or failed for good
+        await self._queue.join()
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        # queued changes are dropped, their futures are cancelled so nobody awaits them forever
+        for member, role, present, future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+
+    async def _work(self) -> None:
+        while True:
+            key = await self._queue.get()
+            member, role, present, future = self._pending.pop(key)
+            try:
+                await self._apply(member, role, present)
+                self.sent += 1
+                done = True
+            except asyncio.CancelledError:
+                # stopped while the change was in flight
+                future.cancel()
+                self._queue.task_done()
+                raise
+            except Exception as e:
+                self.failed += 1
+                done = False
+                logging.error(f'Role dispatcher {self.name}: {"adding" if present else "removing"} {role.name} for {member} failed: {e}')
+            if not future.done():
+                future.set_result(done)
+            self._queue.task_done()
+
+    async def _apply(self, member: discord.Member, role: discord.Role, present: bool) -> None:
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                if present:
+                    await member.add_roles(role)
+                else:
+                    await member.remove_roles(role)
+                metrics.observe_discord_call('roles', start_time)
+                return
+            except discord.HTTPException as e:
+                metrics.observe_discord_call('roles', start_time, e)
+                # a 429 that gets here is a Cloudflare ban or py-cord running out of retries, waiting more won't help
+                if attempt == self.max_retries or e.status < 500:
+                    raise
+                self.retried += 1
+                await asyncio.sleep(get_backoff(attempt))
+
+
+def get_backoff(attempt: int) -> float:
+    # exponential with jitter, so workers that failed together don't retry together
+    return min(2 ** attempt, 60) * random.uniform(0.5, 1.5)
@@ -0,0 +1,109 @@
+import asyncio
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import time
+import discord
+
+
+# parts are kept in memory up to this size, then spooled to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+# an export whose first part grows past this many bytes is gzip-compressed from then on
+EXPORT_GZIP_OVER = int(os.environ.get('EXPORT_GZIP_OVER', 1024 * 1024))
+# room for the gzip trailer and what zlib has not flushed yet when a part is rotated
+PART_SIZE_MARGIN = 64 * 1024
+# Discord accepts at most this many attachments per message
+MAX_FILES_PER_MESSAGE = 10
+
+
+class CSVExport:
+    # Writes CSV rows into attachment parts of at most max_part_size bytes, every part is a complete CSV file with the headers.
+    # Only one batch of rows is held in memory at a time, write_rows and close are blocking and meant to run in a thread.
+    def __init__(self, name: str, headers: list[str], max_part_size: int, format_row=None):
+        self.name = name
+        self.headers = headers
+        self.max_part_size = max_part_size - PART_SIZE_MARGIN
+        self.format_row = format_row
+        # the switch to gzip has to happen while the first part is written, so all parts share one format
+        self.compress_over = min(EXPORT_GZIP_OVER, self.max_part_size // 2)
+        self.compressed = False
+        self.rows = 0
+        self.size = 0
+        self.parts = []
+        self._file = None
+        self._stream = None
+
+    def write_rows(self, rows: list) -> None:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(rows if self.format_row is None else map(self.format_row, rows))
+        data = buffer.getvalue().encode()
+        self.rows += len(rows)
+
+        if self._file is None or (self._file.tell() > 0 and self._file.tell() + len(data) > self.max_part_size):
+            self._open_part()
+        self._stream.write(data)
+        if not self.compressed and self._file.tell() > self.compress_over:
+            self._compress_part()
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self.compressed:
+            self._stream.close()
+        self.size += self._file.tell()
+        self._file.seek(0)
+        self.parts.append(self._file)
+        self._file = self._stream = None
+
+    def discard(self) -> None:
+        for part in self.parts + ([self._file] if self._file is not None else []):
+            part.close()
+        self.parts = []
+        self._file = self._stream = None
+
+    def files(self) -> list[discord.File]:
+        extension = 'csv.gz' if self.compressed else 'csv'
+        if len(self.parts) == 1:
+            return [discord.File(fp=self.parts[0], filename=f'{self.name}.{extension}')]
+        return [discord.File(fp=part, filename=f'{self.name}_{number}.{extension}') for number, part in enumerate(self.parts, start=1)]
+
+    def _open_part(self) -> None:
+        self.close()
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._stream = gzip.GzipFile(fileobj=self._file, mode='wb') if self.compressed else self._file
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(self.headers)
+        self._stream.write(buffer.getvalue().encode())
+
+    def _compress_part(self) -> None:
+        # the export turned out large: recompress what the current part holds and keep writing through gzip
+        raw_file = self._file
+        raw_file.seek(0)
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self._stream = gzip.GzipFile(fileobj=self._file, mode='wb')
+        shutil.copyfileobj(raw_file, self._stream)
+        raw_file.close()
+        self.compressed = True
+
+
+async def export_csv(name: str, headers: list[str], batches, max_part_size: int, format_row=None) -> tuple[CSVExport, float]:
+    # drains the batches (an async iterator of row lists) into a CSVExport, the CSV encoding runs off the event loop
+    start_time = time.time()
+    export = CSVExport(name, headers, max_part_size, format_row)
+    try:
+        async for rows in batches:
+            await asyncio.to_thread(export.write_rows, rows)
+        await asyncio.to_thread(export.close)
+    except BaseException:
+        export.discard()
+        raise
+    finally:
+        # a generator left mid-way still holds its session and read transaction, which blocks WAL checkpoints
+        aclose = getattr(batches, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    return export, time.time() - start_time
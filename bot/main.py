@@ -6,6 +6,7 @@ import os
 import asyncio
 from cogs.vipcog import VIPCommand
 import cogs.vipcog
+import metrics
 
 
 
@@ -36,7 +37,15 @@ async def main():
         await ctx.send("Test command worked!")
 
     # await bot.add_cog(vip_command)
-    await bot.start(TOKEN)
+    metrics.watch_rate_limits()
+    await metrics.start_server()
+    try:
+        await bot.start(TOKEN)
+    finally:
+        # let scheduled events that already started finish before the loop goes away
+        cog = bot.get_cog('VIPCommand')
+        bot.unload_extension('cogs.vipcog')
+        await cog.closing
 
 
 if __name__ == '__main__':
@@ -0,0 +1,297 @@
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from aiohttp import web
+from sqlalchemy import event
+
+
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+# the endpoint is off when METRICS_PORT is 0
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+# a statement shape repeated more often than this within one command or task is reported as a suspected N+1
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 20))
+
+registry = []
+# the operations helper running in this task, statements are counted against it
+current_helper = contextvars.ContextVar('current_helper', default='')
+# the command or task running in this task, see Invocation
+current_invocation = contextvars.ContextVar('current_invocation', default=None)
+# called with every finished Invocation
+invocation_listeners = []
+
+
+class Metric:
+    # A metric family, every combination of label values is one series. Updating a series is a dict lookup and an
+    # addition, cheap enough to stay on for every statement and Discord call
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._series = {}
+        registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = '') -> str:
+        pairs = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, key)] + ([extra] if extra else [])
+        return f'{{{",".join(pairs)}}}' if pairs else ''
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{self._format_labels(key)} {format_value(value)}' for key, value in self._series.items()]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}'] + self.samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # set directly, or read from a function when the endpoint is scraped
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._functions = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._series[self._key(labels)] = value
+
+    def set_function(self, function, **labels) -> None:
+        self._functions[self._key(labels)] = function
+
+    def samples(self) -> list[str]:
+        for key, function in self._functions.items():
+            try:
+                self._series[key] = function()
+            except Exception as e:
+                logging.error(f'Metric {self.name}: {e}')
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str] = (), buckets: tuple[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # one count per bucket (not cumulative yet), then the sum and the count
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = self._format_labels(key, 'le="%s"' % format_value(bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = self._format_labels(key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {series[-1]}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {format_value(series[-2])}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {series[-1]}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+COMMAND_SECONDS = Histogram('hermes_command_seconds', 'Slash command latency', ('command',))
+COMMAND_ERRORS = Counter('hermes_command_errors_total', 'Errors reported to the owner, by command (empty for tasks and events)', ('command',))
+DB_HELPER_SECONDS = Histogram('hermes_db_helper_seconds', 'Duration of an operations helper call', ('helper',))
+DB_QUERIES = Counter('hermes_db_queries_total', 'SQL statements, by the operations helper that ran them (empty outside of helpers)', ('helper',))
+DB_QUERY_SECONDS = Histogram('hermes_db_query_seconds', 'Duration of a SQL statement', ('helper',))
+DISCORD_SECONDS = Histogram('hermes_discord_request_seconds', 'Duration of a Discord API call', ('route',))
+DISCORD_ERRORS = Counter('hermes_discord_errors_total', 'Discord API calls that raised, after py-cord gave up retrying', ('route', 'status'))
+DISCORD_RATE_LIMITS = Counter('hermes_discord_rate_limits_total', 'Discord API responses answered with a 429, counted from the warning py-cord logs before it sleeps and retries (the call itself succeeds), by route path', ('path',))
+DISCORD_RATE_LIMIT_SECONDS = Counter('hermes_discord_rate_limit_seconds_total', 'Seconds py-cord slept on 429s before retrying, part of hermes_discord_request_seconds', ('path',))
+SCHEDULER_LAG = Histogram('hermes_scheduler_lag_seconds', 'Delay between the due time of a scheduled event and its run', ('scheduler',))
+SCHEDULER_PENDING = Gauge('hermes_scheduler_pending', 'Scheduled events waiting', ('scheduler',))
+ROLE_QUEUE = Gauge('hermes_role_changes_queued', 'Role changes waiting in the dispatcher')
+DIGEST_SAVED = Gauge('hermes_digest_messages_saved', 'Admin messages saved by batching notifications into digests')
+BACKUP_SECONDS = Gauge('hermes_backup_seconds', 'Duration of the last database backup (copy and compression)')
+BACKUP_SIZE = Gauge('hermes_backup_size_bytes', 'Size of the last compressed database backup')
+BACKUP_TIMESTAMP = Gauge('hermes_backup_last_success_timestamp', 'Unix time of the last successful backup')
+BACKUP_FAILURES = Counter('hermes_backup_failures_total', 'Failed database backups')
+INVOCATION_STATEMENTS = Histogram('hermes_invocation_statements', 'SQL statements of one command or task run', ('command',), COUNT_BUCKETS)
+INVOCATION_DB_SECONDS = Histogram('hermes_invocation_db_seconds', 'Time spent in SQL statements by one command or task run', ('command',))
+N_PLUS_ONE = Counter('hermes_suspected_n_plus_one_total', 'Command or task runs that repeated a statement shape more than N_PLUS_ONE_THRESHOLD times', ('command',))
+
+
+class Invocation:
+    # The statements of one slash command or task run, grouped by shape. Tasks it creates inherit it with the context,
+    # once it is finished their statements are no longer counted
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = 0
+        self.seconds = 0.0
+        self.shapes = {}
+        self.finished = False
+
+    def add(self, statement: str, seconds: float, executemany: bool = False) -> None:
+        self.statements += 1
+        self.seconds += seconds
+        # batches of one executemany (insertmanyvalues sends one statement per batch) are what N+1 queries should become
+        if not executemany:
+            shape = statement_shape(statement)
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def suspected_n_plus_one(self, threshold: int = None) -> dict[str, int]:
+        threshold = N_PLUS_ONE_THRESHOLD if threshold is None else threshold
+        return {shape: count for shape, count in self.shapes.items() if count > threshold}
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_shape(statement: str) -> str:
+    # parameter lists of any length are one shape, so a chunked IN (...) and the same lookup per row look alike
+    return re.sub(r'\?(\s*,\s*\?)+', '?, ...', ' '.join(statement.split()))
+
+
+def start_invocation(name: str) -> Invocation:
+    invocation = Invocation(name)
+    current_invocation.set(invocation)
+    return invocation
+
+
+def finish_invocation(invocation: Invocation) -> None:
+    invocation.finished = True
+    INVOCATION_STATEMENTS.observe(invocation.statements, command=invocation.name)
+    INVOCATION_DB_SECONDS.observe(invocation.seconds, command=invocation.name)
+    suspected = invocation.suspected_n_plus_one()
+    if suspected:
+        N_PLUS_ONE.inc(command=invocation.name)
+        for shape, count in suspected.items():
+            logging.warning(f'Suspected N+1 in {invocation.name}: {count} x {shape[:300]}')
+    for listener in invocation_listeners:
+        listener(invocation)
+
+
+@contextmanager
+def invocation(name: str):
+    # for the parts that do not go through the command hooks: tasks, listeners and scheduled events
+    invocation = Invocation(name)
+    token = current_invocation.set(invocation)
+    try:
+        yield invocation
+    finally:
+        current_invocation.reset(token)
+        finish_invocation(invocation)
+
+
+def track_invocation(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with invocation(function.__name__):
+            return await function(*args, **kwargs)
+    return wrapper
+
+
+def db_helper(function):
+    # times an operations helper, the statements it runs are labelled with its name
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        token = current_helper.set(function.__name__)
+        start_time = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            DB_HELPER_SECONDS.observe(time.perf_counter() - start_time, helper=function.__name__)
+            current_helper.reset(token)
+    return wrapper
+
+
+def instrument_engine(engine) -> None:
+    # the events fire in the task that runs the statement, so the context holds its helper and invocation
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # a connection runs one statement at a time, a statement that raised is simply overwritten
+        conn.info['metrics_start_time'] = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_start_time']
+        helper = current_helper.get()
+        DB_QUERIES.inc(helper=helper)
+        DB_QUERY_SECONDS.observe(seconds, helper=helper)
+        invocation = current_invocation.get()
+        if invocation is not None and not invocation.finished:
+            invocation.add(statement, seconds, executemany)
+
+
+def observe_discord_call(route: str, start_time: float, error: Exception = None) -> None:
+    DISCORD_SECONDS.observe(time.perf_counter() - start_time, route=route)
+    status = getattr(error, 'status', None)
+    if status is not None:
+        DISCORD_ERRORS.inc(route=route, status=status)
+
+
+class RateLimitHandler(logging.Handler):
+    # py-cord handles 429s inside HTTPClient.request: it logs a warning, sleeps for retry_after and retries, so a 429
+    # only reaches the caller as an exception when Cloudflare blocks the bot. The warning is the one signal there is
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not str(record.msg).startswith('We are being rate limited') or len(record.args) != 2:
+            return
+        retry_after, bucket = record.args
+        # the bucket is '<channel id>:<guild id>:<path template>', the template keeps the label set small
+        path = str(bucket).split(':', 2)[-1]
+        DISCORD_RATE_LIMITS.inc(path=path)
+        DISCORD_RATE_LIMIT_SECONDS.inc(float(retry_after), path=path)
+
+
+def watch_rate_limits(logger: logging.Logger = logging.getLogger('discord.http')) -> None:
+    # the records must not be filtered out by the logger level, py-cord logs them as warnings
+    if not any(isinstance(handler, RateLimitHandler) for handler in logger.handlers):
+        logger.addHandler(RateLimitHandler())
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f'Metrics served on http://{host}:{port}/metrics')
+    return runner
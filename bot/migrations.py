@@ -0,0 +1,129 @@
+import logging
+from argparse import ArgumentParser
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection, Engine
+
+
+# columns recorded by the change journal triggers of migration 5, frozen like the migration itself
+JOURNAL_COLUMNS_V5 = {
+    'users': ['id', 'discord_uid', 'username', 'free_trial_used'],
+    'subscriptions': ['id', 'start_date', 'end_date', 'user_id', 'active'],
+    'unique_codes': ['id', 'code', 'redeemed', 'expiry_date', 'duration_id', 'admin_id'],
+    'redeemed_codes': ['id', 'redemption_date', 'unique_code_id', 'subscription_id'],
+    'grants': ['id', 'grant_date', 'action_type', 'original_end_date', 'new_end_date', 'duration_id', 'subscription_id', 'admin_id', 'user_id'],
+    'revokes': ['id', 'revoke_date', 'action_type', 'original_end_date', 'new_end_date', 'duration_id', 'subscription_id', 'admin_id', 'user_id'],
+}
+
+
+def journal_statements(journal_columns: dict[str, list[str]]) -> list[str]:
+    # one AFTER INSERT, UPDATE and DELETE trigger per table, each appends the row (as JSON) to change_journal
+    statements = []
+    for table_name, columns in journal_columns.items():
+        pairs = ', '.join(f"'{column}', NEW.{column}" for column in columns)
+        row_data = f'json_object({pairs})'
+        for op, event_name, row, data in [('I', 'INSERT', 'NEW', row_data), ('U', 'UPDATE', 'NEW', row_data), ('D', 'DELETE', 'OLD', 'NULL')]:
+            statements.append(
+                f'CREATE TRIGGER IF NOT EXISTS journal_{table_name}_{event_name.lower()} AFTER {event_name} ON {table_name} BEGIN '
+                f"INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('{table_name}', '{op}', {row}.id, {data}); END"
+            )
+    return statements
+
+
+# Schema changes for an existing database, applied in order and tracked with PRAGMA user_version.
+# Released migrations must never be edited, append a new version instead.
+MIGRATIONS = [
+    (1, 'index subscriptions for active subscription lookups', [
+        'CREATE INDEX IF NOT EXISTS ix_subscriptions_user_end_start ON subscriptions (user_id, end_date, start_date)',
+    ]),
+    (2, 'index unique codes for the expired code sweep', [
+        'CREATE INDEX IF NOT EXISTS ix_unique_codes_redeemed_expiry ON unique_codes (redeemed, expiry_date)',
+    ]),
+    (3, 'index grants and revokes by user', [
+        'CREATE INDEX IF NOT EXISTS ix_grants_user_id ON grants (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_revokes_user_id ON revokes (user_id)',
+    ]),
+    (4, 'persist pending free trials', [
+        'CREATE TABLE IF NOT EXISTS free_trials ('
+        ' id INTEGER NOT NULL PRIMARY KEY,'
+        ' discord_uid INTEGER UNIQUE NOT NULL,'
+        ' expires_at DATETIME NOT NULL,'
+        ' kept BOOLEAN CHECK(kept IN (0, 1)) NOT NULL DEFAULT 0)',
+    ]),
+    (5, 'journal every change for incremental backups', [
+        'CREATE TABLE IF NOT EXISTS change_journal ('
+        ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' table_name TEXT NOT NULL,'
+        " op TEXT CHECK(op IN ('I', 'U', 'D')) NOT NULL,"
+        ' row_id INTEGER NOT NULL,'
+        ' row_data TEXT,'
+        " changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')))",
+    ] + journal_statements(JOURNAL_COLUMNS_V5)),
+    (6, 'remember the journal seq a restored database was replayed to', [
+        'CREATE TABLE IF NOT EXISTS journal_state ('
+        ' id INTEGER NOT NULL PRIMARY KEY CHECK(id = 1),'
+        ' applied_seq INTEGER NOT NULL)',
+    ]),
+]
+
+# hot path queries and the index each of them is expected to use
+QUERY_PLANS = {
+    'ix_subscriptions_user_end_start': (
+        'SELECT * FROM subscriptions WHERE user_id = ? AND start_date <= ? AND end_date > ? ORDER BY start_date DESC',
+        (1, '2000-01-01 00:00:00.000000', '2000-01-01 00:00:00.000000'),
+    ),
+    'ix_unique_codes_redeemed_expiry': (
+        'SELECT * FROM unique_codes WHERE redeemed = 0 AND expiry_date < ?',
+        ('2000-01-01 00:00:00.000000',),
+    ),
+    'ix_grants_user_id': ('SELECT * FROM grants WHERE user_id = ?', (1,)),
+    'ix_revokes_user_id': ('SELECT * FROM revokes WHERE user_id = ?', (1,)),
+}
+
+
+def get_version(connection: Connection) -> int:
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def migrate(engine: Engine) -> list[int]:
+    with engine.connect() as connection:
+        version = get_version(connection)
+
+    applied = []
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        # each migration commits on its own, together with the version bump
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(f'PRAGMA user_version = {migration_version}')
+        logging.info(f'Applied migration {migration_version}: {description}')
+        applied.append(migration_version)
+    return applied
+
+
+def check_query_plans(connection: Connection) -> dict[str, bool]:
+    results = {}
+    for index_name, (query, params) in QUERY_PLANS.items():
+        plan = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {query}', params).all()
+        results[index_name] = any(index_name in row[-1] for row in plan)
+        if not results[index_name]:
+            logging.warning(f'Query does not use {index_name}: {query} -> {[row[-1] for row in plan]}')
+    return results
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-db', '--database', type=str, default='database.db', help='Database file to migrate')
+    parser.add_argument('-c', '--check', action='store_true', help='Only check the hot path query plans')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    engine = create_engine(f'sqlite:///{args.database}')
+    if not args.check:
+        migrate(engine)
+    with engine.connect() as connection:
+        logging.info(f'Schema version {get_version(connection)}, query plans: {check_query_plans(connection)}')
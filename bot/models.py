@@ -253,3 +253,26 @@ class Revoke(Base):
     
     def __eq__(self, other):
         return type(self) == type(other) and self.id == other.id
+
+
+class FreeTrial(Base):
+    __tablename__ = 'free_trials'
+
+    id = Column(Integer, primary_key=True)
+    discord_uid = Column(Integer, unique=True, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    kept = Column(Boolean, CheckConstraint("kept IN (0, 1)"), nullable=False, default=False)
+
+    def __init__(self, discord_uid, expires_at):
+        self.discord_uid = discord_uid
+        self.expires_at = expires_at
+        self.kept = False
+
+    def __repr__(self):
+        return f'<FreeTrial(id={self.id}, discord_uid={self.discord_uid}, expires_at={self.expires_at}, kept={self.kept})>'
+    
+    def __str__(self):
+        return f'FreeTrial(id={self.id}, discord_uid={self.discord_uid}, expires_at={self.expires_at}, kept={self.kept})'
+    
+    def __eq__(self, other):
+        return type(self) == type(other) and self.id == other.id
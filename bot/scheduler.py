@@ -0,0 +1,87 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime
+
+import metrics
+
+
+class Scheduler:
+    # A single task sleeps until the earliest pending deadline: entries live in a min-heap ordered by due time,
+    # rescheduling a key just pushes a new entry and the superseded one is skipped when it surfaces.
+    # Every due callback runs in a task of its own, so a slow one never delays the deadlines after it; stop() waits for them.
+    def __init__(self, name: str):
+        self.name = name
+        self.last_lag = 0.0
+        self._heap = []
+        self._tokens = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __contains__(self, key) -> bool:
+        return key in self._tokens
+
+    def schedule(self, key, when: datetime, callback, *args) -> None:
+        token = next(self._counter)
+        self._tokens[key] = token
+        heapq.heappush(self._heap, (when, token, key, callback, args))
+        if len(self._heap) > 2 * len(self._tokens) + 64:
+            self._compact()
+        if self._heap[0][1] == token:
+            # new earliest deadline, the runner has to re-arm its timer
+            self._wakeup.set()
+
+    def cancel(self, key) -> bool:
+        return self._tokens.pop(key, None) is not None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # callbacks already started are left to finish, they may be halfway through a database write
+        await asyncio.gather(*self._running)
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if self._tokens.get(entry[2]) == entry[1]]
+        heapq.heapify(self._heap)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._tokens.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, token, key, callback, args = heapq.heappop(self._heap)
+            del self._tokens[key]
+            self.last_lag = (datetime.now() - when).total_seconds()
+            metrics.SCHEDULER_LAG.observe(self.last_lag, scheduler=self.name)
+            task = asyncio.create_task(self._call(key, callback, args))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _call(self, key, callback, args) -> None:
+        try:
+            await callback(*args)
+        except Exception as e:
+            logging.error(f'Scheduler {self.name}: {key} failed: {e}')
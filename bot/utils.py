@@ -3,9 +3,11 @@ import string
 import random
 import discord
 import logging
+import time
 
 import operations as ops
 import models as mdls
+import metrics
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,15 +17,20 @@ DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
 # User helpers
-async def get_or_add_member(member: discord.Member) -> tuple[mdls.User, bool]:
+async def get_or_add_member(member: discord.Member, session=None) -> tuple[mdls.User, bool]:
     discord_uid = member.id
     username = member.name + "#" + member.discriminator
     isNew = False
-    user = await ops.get_user_by_discord_uid(discord_uid)
+    user = await ops.get_cached_user(discord_uid, session)
+    if user:
+        return user, isNew
+    user = await ops.get_user_by_discord_uid(discord_uid, session)
     if not user:
         isNew = True
         user = mdls.User(discord_uid, username)
-        await ops.add_user(user)
+        await ops.add_user(user, session)
+    else:
+        ops.cache_user(user)
     return user, isNew
 
 
@@ -45,11 +52,11 @@ def parse_duration(duration: str) -> tuple[int, str]:
     else:
         return None, None
     
-async def validate_duration(duration: str) -> tuple[mdls.SubDuration, str]:
+async def validate_duration(duration: str, session=None) -> tuple[mdls.SubDuration, str]:
     duration_value, duration_unit = parse_duration(duration)
     if not duration_value or not duration_unit:
         return None, 'Invalid duration. Duration is not in the correct format.'
-    sub_duration = await ops.get_sub_duration(duration_value, duration_unit)
+    sub_duration = await ops.get_sub_duration(duration_value, duration_unit, session)
     if not sub_duration:
         return None, 'Invalid duration. Duration is not part of the allowed durations.'
     return sub_duration, None
@@ -63,18 +70,23 @@ def gen_code(l: int) -> str:
     random_code = ''.join(random.choice(unique_digits) for _ in range(l))
     return f'{random_code[:l//3]}-{random_code[l//3:2*l//3]}-{random_code[2*l//3:]}'
 
+async def gen_unique_codes(l: int, count: int) -> list[str]:
+    # draw candidates in memory and drop the ones already taken with one membership query per round
+    codes = set()
+    while len(codes) < count:
+        candidates = {gen_code(l) for _ in range(count - len(codes))} - codes
+        codes |= candidates - await ops.get_existing_codes(candidates)
+    return list(codes)
+
 async def gen_unique_code(l: int) -> str:
-    await ops.delete_expired_unique_codes()
-    code = gen_code(l)
-    while await ops.get_unique_code_by_code(code):
-        code = gen_code(l)
-    return code
-
-async def validate_code(code: str) -> tuple[mdls.UniqueCode, str]:
-    unique_code = await ops.get_unique_code_by_code(code)
+    codes = await gen_unique_codes(l, 1)
+    return codes[0]
+
+async def validate_code(code: str, session=None) -> tuple[mdls.UniqueCode, str]:
+    unique_code = await ops.get_unique_code_by_code(code, session)
     if not unique_code:
         return None, 'Invalid code. This code does not exist.'
-    if unique_code.is_redeemed():
+    if unique_code.redeemed:
         return None, 'This code has been claimed.'
     if unique_code.is_expired():
         return None, 'This code has expired.'
@@ -131,7 +143,34 @@ def owner_embed(title: str, description: str = '') -> discord.Embed:
 def datetime_to_string(dt: datetime) -> str:
     return dt.strftime(DATETIME_FORMAT)
 
+def subscription_status(start_date: datetime, end_date: datetime, now: datetime) -> str:
+    # same wording as the Subscription model checks, for rows that are not loaded as objects
+    if start_date <= now < end_date:
+        return 'Active'
+    if now <= start_date < end_date:
+        return 'pending'
+    if end_date <= now:
+        return 'Expired'
+    return 'Unknown'
+
+def format_backup_stats(stats: dict) -> str:
+    return (f"{round(stats['database_size'] / 1024 / 1024, 2)} MiB copied in {round(stats['backup_seconds'], 2)}s, "
+            f"{round(stats['backup_size'] / 1024 / 1024, 2)} MiB compressed in {round(stats['compress_seconds'], 2)}s, "
+            f"{stats['pruned']} old backups pruned")
+
 def get_admins_and_owners(guild) -> list:
     owner_role = discord.utils.get(guild.roles, name="👑 Owner")
     admin_role = discord.utils.get(guild.roles, name="🛡️ Admin")
-    return owner_role.members + admin_role.members
\ No newline at end of file
+    return owner_role.members + admin_role.members
+
+async def send_dm(user, **kwargs) -> bool:
+    # direct messages fail for members that closed them, that is logged and reported instead of raised
+    start_time = time.perf_counter()
+    try:
+        await user.send(**kwargs)
+        metrics.observe_discord_call('dm', start_time)
+        return True
+    except discord.HTTPException as e:
+        metrics.observe_discord_call('dm', start_time, e)
+        logging.error(f"Unable to send message to {user}: {e}")
+        return False
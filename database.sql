@@ -7,7 +7,8 @@
 CREATE TABLE users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     discord_uid INTEGER UNIQUE NOT NULL,
-    username TEXT NOT NULL
+    username TEXT NOT NULL,
+    free_trial_used BOOLEAN DEFAULT 1
 );
 
 -- Table: sub_durations
@@ -84,6 +85,97 @@ CREATE TABLE revokes (
 );
 
 
+-- Table: free_trials (members in their free trial, a row is removed once the trial ended)
+CREATE TABLE free_trials (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    discord_uid INTEGER UNIQUE NOT NULL,
+    expires_at TEXT NOT NULL,
+    kept BOOLEAN CHECK(kept IN (0, 1)) NOT NULL DEFAULT 0
+);
+
+
+-- Table: change_journal (every change to the tables below, for incremental backups)
+CREATE TABLE change_journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    op TEXT CHECK(op IN ('I', 'U', 'D')) NOT NULL,
+    row_id INTEGER NOT NULL,
+    row_data TEXT,
+    changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+
+-- Table: journal_state (a single row, the journal seq a restored database holds the changes up to)
+CREATE TABLE journal_state (
+    id INTEGER NOT NULL PRIMARY KEY CHECK(id = 1),
+    applied_seq INTEGER NOT NULL
+);
+
+-- change journal triggers (kept in sync with bot/migrations.py)
+CREATE TRIGGER journal_users_insert AFTER INSERT ON users BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('users', 'I', NEW.id, json_object('id', NEW.id, 'discord_uid', NEW.discord_uid, 'username', NEW.username, 'free_trial_used', NEW.free_trial_used));
+END;
+CREATE TRIGGER journal_users_update AFTER UPDATE ON users BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('users', 'U', NEW.id, json_object('id', NEW.id, 'discord_uid', NEW.discord_uid, 'username', NEW.username, 'free_trial_used', NEW.free_trial_used));
+END;
+CREATE TRIGGER journal_users_delete AFTER DELETE ON users BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('users', 'D', OLD.id, NULL);
+END;
+CREATE TRIGGER journal_subscriptions_insert AFTER INSERT ON subscriptions BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('subscriptions', 'I', NEW.id, json_object('id', NEW.id, 'start_date', NEW.start_date, 'end_date', NEW.end_date, 'user_id', NEW.user_id, 'active', NEW.active));
+END;
+CREATE TRIGGER journal_subscriptions_update AFTER UPDATE ON subscriptions BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('subscriptions', 'U', NEW.id, json_object('id', NEW.id, 'start_date', NEW.start_date, 'end_date', NEW.end_date, 'user_id', NEW.user_id, 'active', NEW.active));
+END;
+CREATE TRIGGER journal_subscriptions_delete AFTER DELETE ON subscriptions BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('subscriptions', 'D', OLD.id, NULL);
+END;
+CREATE TRIGGER journal_unique_codes_insert AFTER INSERT ON unique_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('unique_codes', 'I', NEW.id, json_object('id', NEW.id, 'code', NEW.code, 'redeemed', NEW.redeemed, 'expiry_date', NEW.expiry_date, 'duration_id', NEW.duration_id, 'admin_id', NEW.admin_id));
+END;
+CREATE TRIGGER journal_unique_codes_update AFTER UPDATE ON unique_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('unique_codes', 'U', NEW.id, json_object('id', NEW.id, 'code', NEW.code, 'redeemed', NEW.redeemed, 'expiry_date', NEW.expiry_date, 'duration_id', NEW.duration_id, 'admin_id', NEW.admin_id));
+END;
+CREATE TRIGGER journal_unique_codes_delete AFTER DELETE ON unique_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('unique_codes', 'D', OLD.id, NULL);
+END;
+CREATE TRIGGER journal_redeemed_codes_insert AFTER INSERT ON redeemed_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('redeemed_codes', 'I', NEW.id, json_object('id', NEW.id, 'redemption_date', NEW.redemption_date, 'unique_code_id', NEW.unique_code_id, 'subscription_id', NEW.subscription_id));
+END;
+CREATE TRIGGER journal_redeemed_codes_update AFTER UPDATE ON redeemed_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('redeemed_codes', 'U', NEW.id, json_object('id', NEW.id, 'redemption_date', NEW.redemption_date, 'unique_code_id', NEW.unique_code_id, 'subscription_id', NEW.subscription_id));
+END;
+CREATE TRIGGER journal_redeemed_codes_delete AFTER DELETE ON redeemed_codes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('redeemed_codes', 'D', OLD.id, NULL);
+END;
+CREATE TRIGGER journal_grants_insert AFTER INSERT ON grants BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('grants', 'I', NEW.id, json_object('id', NEW.id, 'grant_date', NEW.grant_date, 'action_type', NEW.action_type, 'original_end_date', NEW.original_end_date, 'new_end_date', NEW.new_end_date, 'duration_id', NEW.duration_id, 'subscription_id', NEW.subscription_id, 'admin_id', NEW.admin_id, 'user_id', NEW.user_id));
+END;
+CREATE TRIGGER journal_grants_update AFTER UPDATE ON grants BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('grants', 'U', NEW.id, json_object('id', NEW.id, 'grant_date', NEW.grant_date, 'action_type', NEW.action_type, 'original_end_date', NEW.original_end_date, 'new_end_date', NEW.new_end_date, 'duration_id', NEW.duration_id, 'subscription_id', NEW.subscription_id, 'admin_id', NEW.admin_id, 'user_id', NEW.user_id));
+END;
+CREATE TRIGGER journal_grants_delete AFTER DELETE ON grants BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('grants', 'D', OLD.id, NULL);
+END;
+CREATE TRIGGER journal_revokes_insert AFTER INSERT ON revokes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('revokes', 'I', NEW.id, json_object('id', NEW.id, 'revoke_date', NEW.revoke_date, 'action_type', NEW.action_type, 'original_end_date', NEW.original_end_date, 'new_end_date', NEW.new_end_date, 'duration_id', NEW.duration_id, 'subscription_id', NEW.subscription_id, 'admin_id', NEW.admin_id, 'user_id', NEW.user_id));
+END;
+CREATE TRIGGER journal_revokes_update AFTER UPDATE ON revokes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('revokes', 'U', NEW.id, json_object('id', NEW.id, 'revoke_date', NEW.revoke_date, 'action_type', NEW.action_type, 'original_end_date', NEW.original_end_date, 'new_end_date', NEW.new_end_date, 'duration_id', NEW.duration_id, 'subscription_id', NEW.subscription_id, 'admin_id', NEW.admin_id, 'user_id', NEW.user_id));
+END;
+CREATE TRIGGER journal_revokes_delete AFTER DELETE ON revokes BEGIN
+    INSERT INTO change_journal (table_name, op, row_id, row_data) VALUES ('revokes', 'D', OLD.id, NULL);
+END;
+
+-- indexes (kept in sync with bot/migrations.py, which also sets PRAGMA user_version)
+
+CREATE INDEX ix_subscriptions_user_end_start ON subscriptions (user_id, end_date, start_date);
+CREATE INDEX ix_unique_codes_redeemed_expiry ON unique_codes (redeemed, expiry_date);
+CREATE INDEX ix_grants_user_id ON grants (user_id);
+CREATE INDEX ix_revokes_user_id ON revokes (user_id);
+
+PRAGMA user_version = 6;
+
+
 -- Inserting Base Data
 
 INSERT INTO sub_durations (duration, unit) VALUES (1, 'day');
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# the bot modules import each other as top level modules, like when the bot is started from bot/
+BOT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot')
+sys.path.insert(0, BOT_FOLDER)
+
+# operations binds its engine to DATABASE_FILE when imported, the tests that import it share a throw-away database
+os.environ['DATABASE_FILE'] = os.path.join(tempfile.mkdtemp(), 'database.db')
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+import time
+import pytest
+from sqlalchemy import create_engine
+
+import backup
+import migrations
+from models import Base
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = str(tmp_path / 'database.db')
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(bind=engine)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO sub_durations (id, duration, unit) VALUES (1, 1, 'month')")
+    conn.executemany('INSERT INTO users (id, discord_uid, username) VALUES (?, ?, ?)', [(1, 100, 'admin#0001'), (2, 200, 'member#0001')])
+    conn.execute("INSERT INTO subscriptions (id, start_date, end_date, user_id, active) VALUES (1, '2026-01-01 00:00:00.000000', '2026-02-01 00:00:00.000000', 2, 0)")
+    # a plain revoke has no duration
+    conn.execute("INSERT INTO revokes (id, revoke_date, action_type, original_end_date, new_end_date, duration_id, subscription_id, admin_id, user_id) "
+                 "VALUES (1, '2026-01-15 00:00:00.000000', 'revoke', '2026-02-01 00:00:00.000000', '2026-01-15 00:00:00.000000', NULL, 1, 1, 2)")
+    conn.commit()
+    conn.close()
+
+    folder = tmp_path / 'backup'
+    folder.mkdir()
+    monkeypatch.setattr(backup, 'DATABASE_FILE', database)
+    monkeypatch.setattr(backup, 'BACKUP_FOLDER', str(folder))
+    return database
+
+
+def query(database: str, sql: str) -> list:
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('restore', [backup.restore_tables, backup.fast_restore], ids=['restore', 'fast_restore'])
+def test_restore_keeps_nulls(database, restore):
+    tables = backup.list_tables()
+    backup.export_tables(tables)
+    backup.delete_data(list(reversed(tables)))
+    restore(tables)
+
+    assert query(database, 'SELECT duration_id FROM revokes') == [(None,)]
+    assert query(database, 'PRAGMA foreign_key_check') == []
+
+
+def test_fast_restore_keeps_the_journal_sequence(database):
+    backup.export_journal()
+    backup.prune_journal()
+    backup.export_tables(backup.list_tables())
+    checkpoint = backup.read_checkpoint()
+    backup.fast_restore(backup.list_tables())
+
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE users SET username = 'renamed#0001' WHERE id = 2")
+    conn.commit()
+    conn.close()
+    assert query(database, 'SELECT seq FROM change_journal') == [(checkpoint + 1,)]
+    assert backup.export_journal() is not None
+    assert backup.read_checkpoint() == checkpoint + 1
+
+
+def test_journal_behind_the_checkpoint_fails(database):
+    backup.write_checkpoint(10000)
+    with pytest.raises(SystemExit):
+        backup.export_journal()
+    assert not [name for name in os.listdir(backup.BACKUP_FOLDER) if name.endswith('.csv')]
+
+
+def test_replay_continues_from_the_restored_backup(database):
+    backup.export_tables(backup.list_tables())
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE users SET username = 'renamed#0001' WHERE id = 2")
+    conn.commit()
+    conn.close()
+    backup.export_journal()
+    backup.prune_journal()
+    backup.fast_restore(backup.list_tables())
+    assert query(database, 'SELECT username FROM users WHERE id = 2') == [('member#0001',)]
+
+    # the bot writes again before the replay, the journal now ends far past what the backup holds
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO users (id, discord_uid, username) VALUES (3, 300, 'joined#0001')")
+    conn.commit()
+    conn.close()
+    assert backup.replay_journal([]) == 1
+    assert query(database, 'SELECT username FROM users ORDER BY id') == [('admin#0001',), ('renamed#0001',), ('joined#0001',)]
+    # the replayed seq is kept, a second replay has nothing left to do
+    assert backup.replay_journal([]) == 0
+
+
+def test_copy_under_writes_finishes(tmp_path, monkeypatch, caplog):
+    import operations as ops
+    source = str(tmp_path / 'source.db')
+    conn = sqlite3.connect(source)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('CREATE TABLE rows (value TEXT)')
+    conn.executemany('INSERT INTO rows (value) VALUES (?)', [('x' * 500,) for number in range(5000)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(ops, 'BACKUP_PAGES_PER_STEP', 50)
+    monkeypatch.setattr(ops, 'BACKUP_STEP_SLEEP', 0.005)
+
+    # commits between every step of the copy, each of them restarts it
+    stop = threading.Event()
+
+    def write():
+        writer = sqlite3.connect(source)
+        deadline = time.monotonic() + 30
+        while not stop.is_set() and time.monotonic() < deadline:
+            writer.execute("INSERT INTO rows (value) VALUES ('y')")
+            writer.commit()
+            time.sleep(0.001)
+        writer.close()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        ops.copy_database(source, str(tmp_path / 'backup.db'))
+    finally:
+        stop.set()
+        writer.join()
+
+    assert 'copying it in one step' in caplog.text
+    assert query(str(tmp_path / 'backup.db'), 'PRAGMA integrity_check') == [('ok',)]
+    assert query(str(tmp_path / 'backup.db'), 'SELECT COUNT(*) FROM rows')[0][0] >= 5000
@@ -0,0 +1,20 @@
+import pytest
+
+import operations as ops
+from models import User
+
+
+@pytest.mark.asyncio
+async def test_cached_user_joins_a_unit_of_work_once():
+    ops.init_db()
+    user = User(6001, 'cached#0001')
+    await ops.add_user(user)
+    assert ops.user_cache.get(6001) is not None
+
+    async with ops.unit_of_work() as session:
+        cached = await ops.get_cached_user(6001, session)
+        assert await ops.get_cached_user(6001, session) is cached
+        assert await ops.get_user_by_discord_uid(6001, session) is cached
+        await ops.toggle_free_trial_user(cached, session)
+
+    assert (await ops.get_user_by_discord_uid(6001)).free_trial_used
@@ -0,0 +1,35 @@
+import asyncio
+import discord
+import pytest
+
+from digest import AdminDigest
+
+
+class Admin:
+    def __init__(self, admin_id: int):
+        self.id = admin_id
+        self.messages = []
+
+    async def send(self, **kwargs):
+        # slow enough for stop() to catch a flush halfway
+        await asyncio.sleep(0.1)
+        self.messages.append(kwargs)
+
+
+@pytest.mark.asyncio
+async def test_stop_sends_what_is_buffered():
+    digest = AdminDigest('test', 60)
+    admin = Admin(1)
+    digest.add([admin], discord.Embed(title='Subscription ended'))
+    await digest.stop()
+    assert len(admin.messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_stop_lets_a_running_flush_finish():
+    digest = AdminDigest('test', 0.01)
+    admins = [Admin(1), Admin(2)]
+    digest.add(admins, discord.Embed(title='Subscription ended'))
+    await asyncio.sleep(0.05)
+    await digest.stop()
+    assert [len(admin.messages) for admin in admins] == [1, 1]
@@ -0,0 +1,65 @@
+import os
+import pytest
+from sqlalchemy import create_engine
+
+import migrations
+from models import Base
+from conftest import BOT_FOLDER
+
+SCHEMA_FILE = os.path.join(os.path.dirname(BOT_FOLDER), 'database.sql')
+LATEST_VERSION = migrations.MIGRATIONS[-1][0]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # a database as init_db creates it before migrating: the tables of the models and nothing else
+    engine = create_engine(f'sqlite:///{tmp_path / "database.db"}')
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def schema_file_engine(tmp_path):
+    # a database created from database.sql, which has to match the latest migration
+    engine = create_engine(f'sqlite:///{tmp_path / "database.db"}')
+    with open(SCHEMA_FILE) as file:
+        script = file.read()
+    connection = engine.raw_connection()
+    try:
+        connection.executescript(script)
+    finally:
+        connection.close()
+    yield engine
+    engine.dispose()
+
+
+def test_migrate_applies_every_version(engine):
+    assert migrations.migrate(engine) == [version for version, description, statements in migrations.MIGRATIONS]
+    with engine.connect() as connection:
+        assert migrations.get_version(connection) == LATEST_VERSION
+    # a migrated database is left alone
+    assert migrations.migrate(engine) == []
+
+
+def test_hot_path_queries_use_their_indexes(engine):
+    migrations.migrate(engine)
+    with engine.connect() as connection:
+        plans = migrations.check_query_plans(connection)
+    assert plans.keys() == migrations.QUERY_PLANS.keys()
+    assert all(plans.values()), plans
+
+
+def test_schema_file_is_migrated(schema_file_engine):
+    assert migrations.migrate(schema_file_engine) == []
+    with schema_file_engine.connect() as connection:
+        assert migrations.get_version(connection) == LATEST_VERSION
+        plans = migrations.check_query_plans(connection)
+    assert all(plans.values()), plans
+
+
+def test_query_plan_check_reports_missing_indexes(engine):
+    # without the migrations none of the hot path indexes exist, the check must notice
+    with engine.connect() as connection:
+        plans = migrations.check_query_plans(connection)
+    assert not any(plans.values()), plans
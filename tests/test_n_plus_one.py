@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+from conftest import BOT_FOLDER
+
+sys.path.insert(0, os.path.join(os.path.dirname(BOT_FOLDER), 'benchmarks'))
+import suite
+
+# big enough for a per member query to repeat far past N_PLUS_ONE_THRESHOLD
+SIZE = 300
+
+
+@pytest.mark.parametrize('benchmark', suite.BENCHMARKS)
+def test_command_has_no_n_plus_one(benchmark, tmp_path):
+    # every command runs through the benchmark suite on its own seeded database, in a process of its own because the
+    # engine is bound to DATABASE_FILE on import
+    env = dict(os.environ, DATABASE_FILE=str(tmp_path / 'database.db'))
+    output = subprocess.run([sys.executable, suite.__file__, '--run', benchmark, '--sizes', str(SIZE), '--no-memory'], env=env, capture_output=True, text=True, timeout=300)
+    assert output.returncode == 0, output.stderr
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    assert result['errors'] == 0
+    assert result['suspected_n_plus_one'] == {}
@@ -0,0 +1,95 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+
+import migrations
+from models import Base
+from conftest import BOT_FOLDER
+
+PROCESSES = 8
+CODES = 25
+
+
+def date_string(date: datetime) -> str:
+    return date.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def redeem_all(database: str, process: int, barrier, results) -> None:
+    # Runs in its own process with its own engine and connections, so nothing in-process (like ops.write_lock)
+    # serializes it with the others: only the conditional UPDATE decides who gets a code
+    os.environ['DATABASE_FILE'] = database
+    sys.path.insert(0, BOT_FOLDER)
+    import operations as ops
+
+    async def redeem(number: int) -> tuple[str, bool]:
+        code = f'RACE-{number:04d}'
+        user = await ops.get_user_by_discord_uid(user_uid(process, number))
+        # a session of its own bypasses use_write_session's lock
+        async with ops.unit_of_work() as session:
+            subscription, duration, original_end_date = await ops.redeem_code(code, user, session)
+        return code, subscription is not None
+
+    async def main():
+        barrier.wait()
+        return await asyncio.gather(*[redeem(number) for number in range(CODES)], return_exceptions=True)
+
+    results.put((process, [result if isinstance(result, tuple) else repr(result) for result in asyncio.run(main())]))
+
+
+def user_uid(process: int, number: int) -> int:
+    # every racer is a different member, so only the code is contended
+    return 1000 + process * CODES + number
+
+
+def create_database(database: str) -> None:
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(bind=engine)
+    migrations.migrate(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(database)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute("INSERT INTO sub_durations (duration, unit) VALUES (1, 'month')")
+    conn.execute("INSERT INTO users (discord_uid, username) VALUES (1, 'admin#0001')")
+    conn.executemany('INSERT INTO users (discord_uid, username) VALUES (?, ?)',
+                     [(user_uid(process, number), f'member{process}-{number}#0001') for process in range(PROCESSES) for number in range(CODES)])
+    expiry_date = date_string(datetime.now() + timedelta(days=7))
+    conn.executemany('INSERT INTO unique_codes (code, redeemed, expiry_date, duration_id, admin_id) VALUES (?, 0, ?, 1, 1)',
+                     [(f'RACE-{number:04d}', expiry_date) for number in range(CODES)])
+    conn.commit()
+    conn.close()
+
+
+def test_concurrent_redeemers_claim_each_code_once(tmp_path):
+    database = str(tmp_path / 'database.db')
+    create_database(database)
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(PROCESSES)
+    results = context.Queue()
+    processes = [context.Process(target=redeem_all, args=(database, process, barrier, results)) for process in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    outcomes = dict(results.get(timeout=120) for process in processes)
+    for process in processes:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+    # losing a race is a normal outcome, any error means two claims collided further down the transaction
+    errors = [outcome for process_outcomes in outcomes.values() for outcome in process_outcomes if not isinstance(outcome, tuple)]
+    assert errors == []
+    winners = {}
+    for process_outcomes in outcomes.values():
+        for code, won in process_outcomes:
+            winners[code] = winners.get(code, 0) + won
+    assert winners == {f'RACE-{number:04d}': 1 for number in range(CODES)}
+
+    conn = sqlite3.connect(database)
+    assert conn.execute('SELECT COUNT(*) FROM unique_codes WHERE redeemed = 1').fetchone()[0] == CODES
+    assert conn.execute('SELECT COUNT(*) FROM redeemed_codes').fetchone()[0] == CODES
+    assert conn.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0] == CODES
+    conn.close()
@@ -0,0 +1,26 @@
+import asyncio
+from datetime import datetime
+import pytest
+
+from scheduler import Scheduler
+
+
+@pytest.mark.asyncio
+async def test_slow_callback_does_not_delay_the_next_one():
+    scheduler = Scheduler('test')
+    finished = []
+
+    async def callback(name: str, seconds: float):
+        await asyncio.sleep(seconds)
+        finished.append(name)
+
+    now = datetime.now()
+    scheduler.schedule('slow', now, callback, 'slow', 0.5)
+    scheduler.schedule('fast', now, callback, 'fast', 0)
+    scheduler.start()
+    await asyncio.sleep(0.1)
+    assert finished == ['fast']
+
+    # stop waits for the callback still running instead of dropping it
+    await scheduler.stop()
+    assert finished == ['fast', 'slow']